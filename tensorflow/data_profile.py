@@ -0,0 +1,198 @@
+# -*- coding:utf8 -*-
+"""
+This module profiles the preprocessed data files in one pass, to choose max_p_len, max_q_len,
+max_p_num and the length buckets from the data instead of guessing. The passages are selected
+as BRCDataset does, without any length limit, and the report covers:
+    the question, passage and answer span end length distributions,
+    the selected passage counts,
+    the fraction of samples / tokens lost under candidate limits,
+    the bucket boundaries that minimize the padded passage tokens.
+
+Usage: python data_profile.py --train_files ... --dev_files ... --p_limits 300 400 500
+"""
+
+import sys
+sys.path.append('..')
+import json
+import argparse
+import numpy as np
+from collections import Counter
+from dataset import BRCDataset
+from utils import open_file
+
+PERCENTILES = [50, 90, 95, 99, 100]
+
+
+def collect_lengths(data_files, train=False, max_p_num=6):
+    """
+    Collects the lengths of the samples of some files in one pass
+    Args:
+        data_files: the preprocessed (or baked) data files
+        train: if True, the train passage selection is used and the span ends are collected
+        max_p_num: the passages beyond it are not fed to the model
+    Returns:
+        a dict of numpy arrays: q_len, p_len (all fed passages), p_num,
+        max_p_len (longest fed passage of a sample), span_end (train only),
+        and the number of samples dropped regardless of the limits
+    """
+    selector = BRCDataset(max_p_num, sys.maxsize, sys.maxsize)
+    stats = {'q_len': [], 'p_len': [], 'p_num': [], 'max_p_len': [], 'span_end': []}
+    dropped_num = 0
+    for data_file in data_files:
+        with open_file(data_file, 'rb') as fin:
+            for line in fin:
+                sample = selector._select_passages(json.loads(line), train)
+                if sample is None:
+                    dropped_num += 1
+                    continue
+                passages = sample['passages'][:max_p_num]
+                p_lens = [passage.get('orig_passage_len', len(passage['passage_tokens']))
+                          for passage in passages]
+                stats['q_len'].append(len(sample['segmented_question']))
+                stats['p_len'] += p_lens
+                stats['p_num'].append(len(sample['passages']))
+                stats['max_p_len'].append(max(p_lens) if p_lens else 0)
+                if train:
+                    stats['span_end'].append(sample['answer_spans'][0][1])
+    stats = {key: np.array(value, dtype=np.int64) for key, value in stats.items()}
+    stats['dropped_num'] = dropped_num
+    return stats
+
+
+def propose_buckets(lengths, weights, bucket_num):
+    """
+    Finds the bucket upper edges that minimize the padded tokens when every sample is
+    padded to the edge of its bucket, by dynamic programming over the distinct lengths
+    Args:
+        lengths: the padded length of each sample, e.g. its longest passage
+        weights: the number of padded sequences of each sample, e.g. its passage number
+        bucket_num: the maximal number of buckets
+    Returns:
+        the bucket upper edges, ascending, and the padded token count
+    """
+    values, inverse = np.unique(lengths, return_inverse=True)
+    counts = np.bincount(inverse, weights=weights)
+    prefix = np.concatenate([[0], np.cumsum(counts)])
+    value_num = len(values)
+    bucket_num = min(bucket_num, value_num)
+    # cost[b][i]: minimal padded tokens of the first i values with b buckets, the last edge being values[i - 1]
+    cost = np.full((bucket_num + 1, value_num + 1), np.inf)
+    back = np.zeros((bucket_num + 1, value_num + 1), dtype=np.int64)
+    cost[0][0] = 0
+    for b in range(1, bucket_num + 1):
+        for i in range(1, value_num + 1):
+            # the last bucket holds the values j..i-1, padded to values[i - 1]
+            candidates = cost[b - 1][:i] + (prefix[i] - prefix[:i]) * values[i - 1]
+            j = int(np.argmin(candidates))
+            cost[b][i], back[b][i] = candidates[j], j
+    best_b = int(np.argmin(cost[:, value_num]))
+    edges, i = [], value_num
+    for b in range(best_b, 0, -1):
+        edges.append(int(values[i - 1]))
+        i = back[b][i]
+    return edges[::-1], float(cost[best_b][value_num])
+
+
+def random_batch_padding(lengths, weights, batch_size, seed=0):
+    """
+    The padded tokens of shuffled batches, each padded to its longest sample as _dynamic_padding does
+    """
+    order = np.random.RandomState(seed).permutation(len(lengths))
+    padded = 0
+    for start in range(0, len(order), batch_size):
+        batch = order[start: start + batch_size]
+        padded += lengths[batch].max() * weights[batch].sum()
+    return float(padded)
+
+
+def _print_distribution(name, values):
+    if len(values) == 0:
+        return
+    print('{}: mean {:.1f}, '.format(name, values.mean()) + ', '.join(
+        'p{} {}'.format(p, int(np.percentile(values, p))) for p in PERCENTILES))
+
+
+def _print_histogram(name, values, bin_width):
+    if len(values) == 0:
+        return
+    edges = np.arange(0, values.max() + bin_width + 1, bin_width)
+    hist, edges = np.histogram(values, bins=edges)
+    print('{} histogram:'.format(name))
+    for count, low in zip(hist, edges[:-1]):
+        if count:
+            print('  [{:5d}, {:5d}) {:8d} {:6.2%}'.format(int(low), int(low + bin_width), count,
+                                                          1.0 * count / len(values)))
+
+
+def report(stats, set_name, p_limits, q_limits, p_nums, bucket_num, batch_size, bin_width):
+    """
+    Prints the profile of one set
+    """
+    sample_num = len(stats['q_len'])
+    print('==== {}: {} samples, {} dropped by the selection (no usable span) ===='.format(
+        set_name, sample_num, stats['dropped_num']))
+    if sample_num == 0:
+        return
+    _print_distribution('question length', stats['q_len'])
+    _print_distribution('passage length', stats['p_len'])
+    _print_distribution('answer span end', stats['span_end'])
+    _print_histogram('passage length', stats['p_len'], bin_width)
+    _print_histogram('answer span end', stats['span_end'], bin_width)
+    p_num_counts = Counter(stats['p_num'].tolist())
+    print('selected passages per sample: ' + ', '.join(
+        '{}: {:.2%}'.format(num, 1.0 * count / sample_num) for num, count in sorted(p_num_counts.items())))
+
+    for max_p_len in p_limits:
+        line = 'max_p_len {}: {:.2%} passage tokens truncated'.format(
+            max_p_len, 1.0 * np.maximum(stats['p_len'] - max_p_len, 0).sum() / max(stats['p_len'].sum(), 1))
+        if len(stats['span_end']):
+            # the train samples whose span end is >= max_p_len are dropped by _select_passages
+            line += ', {:.2%} train samples lost'.format((stats['span_end'] >= max_p_len).mean())
+        print(line)
+    for max_q_len in q_limits:
+        print('max_q_len {}: {:.2%} questions truncated'.format(max_q_len, (stats['q_len'] > max_q_len).mean()))
+    for max_p_num in p_nums:
+        print('max_p_num {}: {:.2%} samples with passages cut'.format(max_p_num, (stats['p_num'] > max_p_num).mean()))
+
+    if bucket_num > 0:
+        # every fed passage of a sample is padded to the same length
+        weights = np.clip(stats['p_num'], 1, max(p_nums))
+        for max_p_len in p_limits:
+            lengths = np.minimum(stats['max_p_len'], max_p_len)
+            random_padded = random_batch_padding(lengths, weights, batch_size)
+            edges, bucket_padded = propose_buckets(lengths, weights, bucket_num)
+            print('max_p_len {}: {:.0f} padded passage tokens per sample with random batches of {}, '
+                  '{:.0f} with the buckets {}'.format(max_p_len, random_padded / sample_num, batch_size,
+                                                      bucket_padded / sample_num, edges))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Profile the DuReader preprocessed data files')
+    parser.add_argument('--train_files', nargs='+', default=[],
+                        help='train files, profiled with the train passage selection')
+    parser.add_argument('--dev_files', nargs='+', default=[],
+                        help='dev files, profiled with the dev/test passage selection')
+    parser.add_argument('--test_files', nargs='+', default=[],
+                        help='test files, profiled with the dev/test passage selection')
+    parser.add_argument('--p_limits', type=int, nargs='+', default=[300, 400, 500],
+                        help='candidate max_p_len')
+    parser.add_argument('--q_limits', type=int, nargs='+', default=[30, 60],
+                        help='candidate max_q_len')
+    parser.add_argument('--p_nums', type=int, nargs='+', default=[5, 6],
+                        help='candidate max_p_num')
+    parser.add_argument('--bucket_num', type=int, default=4,
+                        help='number of length buckets to propose, 0 to skip')
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='batch size of the random batching baseline')
+    parser.add_argument('--bin_width', type=int, default=50,
+                        help='bin width of the length histograms')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    for set_name, data_files in [('train', args.train_files), ('dev', args.dev_files), ('test', args.test_files)]:
+        if data_files:
+            stats = collect_lengths(data_files, train=set_name == 'train', max_p_num=max(args.p_nums))
+            report(stats, set_name, args.p_limits, args.q_limits, args.p_nums,
+                   args.bucket_num, args.batch_size, args.bin_width)
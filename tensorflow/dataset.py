@@ -19,24 +19,111 @@ This module implements data process strategies.
 """
 
 import os
+import sys
 import json
+import shutil
 import logging
 import numpy as np
 from collections import Counter
+from paragraph_selection import select_top_paragraphs, iter_ranked_paragraphs
+from utils import open_file, is_compressed
 ##改进：全局选择most_related_paras（5个？） 和 fake_span（1个）
 
+def _deep_size(obj, seen=None):
+    """
+    Estimates the memory used by obj and the containers and strings it holds, in bytes
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(k, seen) + _deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_deep_size(item, seen) for item in obj)
+    return size
+
+
+# the arrays of a published set, the ragged fields are flat with their offsets
+SHARED_FIELDS = ['question_ids', 'question_type_ids', 'question_token_ids', 'question_offsets',
+                 'sample_offsets', 'passage_ids', 'passage_offsets', 'recall_scores',
+                 'fake_span_orders', 'answer_spans', 'raw_locations']
+
+
+class SharedSamples(object):
+    """
+    A read-only list of the compact samples of a set published by BRCDataset.publish_shared,
+    the arrays are memory-mapped so that the processes attached to them share the page cache,
+    and a sample dict is built on every access
+    """
+    def __init__(self, shared_dir, set_name, question_types):
+        self.question_types = question_types
+        for field in SHARED_FIELDS:
+            setattr(self, field, np.load(os.path.join(shared_dir, '{}_{}.npy'.format(set_name, field)),
+                                         mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.question_ids)
+
+    def __getitem__(self, idx):
+        passages = []
+        for pidx in range(self.sample_offsets[idx], self.sample_offsets[idx + 1]):
+            passage = {'passage_token_ids': self.passage_ids[self.passage_offsets[pidx]: self.passage_offsets[pidx + 1]].tolist()}
+            if not np.isnan(self.recall_scores[pidx]):
+                passage['recall_score'] = float(self.recall_scores[pidx])
+            passages.append(passage)
+        sample = {'question_id': int(self.question_ids[idx]),
+                  'question_type': self.question_types[self.question_type_ids[idx]],
+                  'question_token_ids': self.question_token_ids[self.question_offsets[idx]: self.question_offsets[idx + 1]].tolist(),
+                  'passages': passages,
+                  'fake_span_order': int(self.fake_span_orders[idx]),
+                  'raw_location': (int(self.raw_locations[idx][0]), int(self.raw_locations[idx][1]))}
+        if self.answer_spans[idx][0] != -1:
+            sample['answer_spans'] = [self.answer_spans[idx].tolist()]
+        return sample
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
 class BRCDataset(object):
     """
     This module implements the APIs for loading and using baidu reading comprehension dataset
     """
     def __init__(self, max_p_num, max_p_len, max_q_len,
-                 train_files=[], dev_files=[], test_files=[]):
+                 train_files=[], dev_files=[], test_files=[],
+                 p_window_budget=0, p_window_size=20, dedup_threshold=0, lazy_raw_data=False,
+                 slim_load=False, pack_len=0):
         self.logger = logging.getLogger("brc")
         self.max_p_num = max_p_num
         self.max_p_len = max_p_len
         self.max_q_len = max_q_len
+        # passages longer than p_window_budget are compressed to their windows
+        # with the highest question overlap, 0 disables the compression
+        self.p_window_budget = min(p_window_budget, max_p_len)
+        self.p_window_size = p_window_size
+        # 1 drops the exact duplicate passages of a sample, a value below 1 also drops the near
+        # duplicates with this trigram jaccard similarity, 0 disables the deduplication
+        self.dedup_threshold = dedup_threshold
+        # if True, only ids, spans and the byte offset of a sample are kept in memory after
+        # convert_to_ids, and the text fields are parsed again from the file when needed
+        self.lazy_raw_data = lazy_raw_data
+        self.raw_files = []
+        # if True, the passages are truncated to max_p_len at load time
+        # and the fields not used after the passage selection are dropped
+        self.slim_load = slim_load
+        # if > 0, the passages of a sample are packed into rows of up to pack_len (>= max_p_len) tokens
+        self.pack_len = max(pack_len, max_p_len) if pack_len > 0 else 0
+        # the size of the vocab used by convert_to_ids
+        self.vocab_hash = None
+        # the candidate and dropped passage numbers of the deduplication, reset for each file
+        self.dedup_counts = [0, 0]
 
         self.train_set, self.dev_set, self.test_set = [], [], []
+        self.dev_sources, self.dev_subset = [], []
         if train_files:
             for train_file in train_files:
                 self.train_set += self._load_dataset(train_file, train=True)
@@ -44,7 +131,10 @@ class BRCDataset(object):
 
         if dev_files:
             for dev_file in dev_files:
-                self.dev_set += self._load_dataset(dev_file)
+                dev_samples = self._load_dataset(dev_file)
+                self.dev_set += dev_samples
+                # search/zhidao, used to stratify the dev subset
+                self.dev_sources += [os.path.basename(dev_file).split('.')[0]] * len(dev_samples)
             self.logger.info('Dev set size: {} questions.'.format(len(self.dev_set)))
 
         if test_files:
@@ -56,85 +146,315 @@ class BRCDataset(object):
         """
         Loads the dataset
         Args:
-            data_path: the data file to load
+            data_path: the data file to load, a .gz/.bz2/.xz file is decompressed on the fly
         """
-        with open(data_path) as fin:
+        self.dedup_counts = [0, 0]
+        raw_file_idx = len(self.raw_files)
+        self.raw_files.append((data_path, train))
+        # seeking backwards in a compressed stream decompresses it again from the start
+        lazy_raw_data = self.lazy_raw_data and not is_compressed(data_path)
+        if self.lazy_raw_data and not lazy_raw_data:
+            self.logger.warning('{} is compressed, its samples are kept in memory instead of lazy_raw_data.'.format(
+                data_path))
+        with open_file(data_path, 'rb') as fin:
             data_set = []
+            offset = 0
+            slim_sizes = []
             for lidx, line in enumerate(fin):
-                sample = json.loads(line.strip())
-                bestspan_idx=-1
-                if train:
-                    if 'spanScore_f1' in sample:
-                        bestspan_idx=0
-                        if len(sample['spanScore_f1']) == 0:
-                            continue
-                        if sample['spanScore_f1'][bestspan_idx][0]==-1:
-                            continue
-                        if sample['spanScore_f1'][bestspan_idx][2][1] >= self.max_p_len:
-                            continue
-                    else:
-                        assert 'multi_spanScore_f1' in sample
-                        if len(sample['multi_spanScore_f1']) == 0:
-                            continue
-                        bestspan_matchscore=0.0
-                        for r_idx,record in enumerate(sample['multi_spanScore_f1']):
-                            if record[0][-1]>bestspan_matchscore:
-                                bestspan_matchscore=record[0][-1]
-                                bestspan_idx=r_idx
-                        if bestspan_idx==-1:
-                            continue
-                        if sample['multi_spanScore_f1'][bestspan_idx][0][2][1] >= self.max_p_len:
-                            continue
-
-                sample['passages'] = []#全局选择
-                
-                if train:
-                    score_field='paragScore_recall_a'
-                else:
-                    score_field='paragScore_recall_q'
-                
-                paragScoreRecords=[]
-                
-                
-                for k,v in sample[score_field].items():
-                    for item in v:
-                        paragScoreRecords.append((k,item[0],item[1]))
-                sortedParagResult=sorted(paragScoreRecords, key=lambda record: record[-1],reverse=True)
-                if train:
-                    if 'spanScore_f1' in sample:
-                        spanScoreRecord=sample['spanScore_f1'][bestspan_idx]
-                        fake_span_didx, fake_span_pidx=spanScoreRecord[0], spanScoreRecord[1]
-                        sample['answer_spans']=[spanScoreRecord[2]]
-                    else:
-                        assert 'multi_spanScore_f1' in sample
-                        spanScoreRecord=sample['multi_spanScore_f1'][bestspan_idx][0]
-                        fake_span_didx, fake_span_pidx=spanScoreRecord[0], spanScoreRecord[1]
-                        sample['answer_spans']=[spanScoreRecord[2]]
-
-                odr=-1
-                for r_idx, paragScoreRecord in enumerate(sortedParagResult[:5]):#取前5?
-                    if train and int(paragScoreRecord[0])==fake_span_didx and paragScoreRecord[1]==fake_span_pidx:
-                        odr=r_idx
-                    if train:
-                        sample['passages'].append(
-                                {'passage_tokens': sample['documents'][int(paragScoreRecord[0])]['segmented_paragraphs'][paragScoreRecord[1]],
-                                 'is_selected': sample['documents'][int(paragScoreRecord[0])]['is_selected']}
-                            )
-                    else:
-                        sample['passages'].append(
-                                {'passage_tokens': sample['documents'][int(paragScoreRecord[0])]['segmented_paragraphs'][paragScoreRecord[1]]})
-                if odr==-1:
-                    if train:
-                        odr=5
-                        sample['passages'].append(
-                                {'passage_tokens': sample['documents'][fake_span_didx]['segmented_paragraphs'][fake_span_pidx],
-                                 'is_selected': sample['documents'][fake_span_didx]['is_selected']}
-                            )
-                sample['fake_span_order']=odr
-                sample.pop('documents')
-                data_set.append(sample)
+                sample = self._select_passages(json.loads(line.strip()), train)
+                if sample is not None:
+                    if self.slim_load:
+                        # the memory report is estimated on the first samples
+                        measure = len(slim_sizes) < 100
+                        size_before = _deep_size(sample) if measure else 0
+                        self._slim_sample(sample)
+                        if measure:
+                            slim_sizes.append((size_before, _deep_size(sample)))
+                    if lazy_raw_data:
+                        # the byte offset of the sample, its text fields are parsed again from there
+                        sample['raw_location'] = (raw_file_idx, offset)
+                    data_set.append(sample)
+                offset += len(line)
+        if slim_sizes:
+            self.logger.info('Slim load of {}: {:.0f} bytes per sample before, {:.0f} after.'.format(
+                data_path, 1.0 * sum(size[0] for size in slim_sizes) / len(slim_sizes),
+                1.0 * sum(size[1] for size in slim_sizes) / len(slim_sizes)))
+        if self.dedup_threshold > 0:
+            self.logger.info('Dropped {} duplicate passages out of {} candidates ({:.2%}) in {}.'.format(
+                self.dedup_counts[1], self.dedup_counts[0],
+                1.0 * self.dedup_counts[1] / max(self.dedup_counts[0], 1), data_path))
         return data_set
 
+    def _select_passages(self, sample, train=False):
+        """
+        Globally selects the passages of a raw sample and locates its fake span
+        Returns:
+            the sample, None if the sample should be dropped
+        """
+        if 'documents' not in sample and 'fake_span_order' in sample:
+            # a record baked by bake_sample, its passages are already selected
+            if train and not self.p_window_budget and sample['answer_spans'][0][1] >= self.max_p_len:
+                return None
+            if self.p_window_budget and not self._compress_passages(sample, train):
+                return None
+            return sample
+
+        bestspan_idx=-1
+        if train:
+            if 'spanScore_f1' in sample:
+                bestspan_idx=0
+                if len(sample['spanScore_f1']) == 0:
+                    return None
+                if sample['spanScore_f1'][bestspan_idx][0]==-1:
+                    return None
+                if not self.p_window_budget and sample['spanScore_f1'][bestspan_idx][2][1] >= self.max_p_len:
+                    return None
+            else:
+                assert 'multi_spanScore_f1' in sample
+                if len(sample['multi_spanScore_f1']) == 0:
+                    return None
+                bestspan_matchscore=0.0
+                for r_idx,record in enumerate(sample['multi_spanScore_f1']):
+                    if record[0][-1]>bestspan_matchscore:
+                        bestspan_matchscore=record[0][-1]
+                        bestspan_idx=r_idx
+                if bestspan_idx==-1:
+                    return None
+                if not self.p_window_budget and \
+                        sample['multi_spanScore_f1'][bestspan_idx][0][2][1] >= self.max_p_len:
+                    return None
+
+        sample['passages'] = []#全局选择
+        
+        if train:
+            score_field='paragScore_recall_a'
+        else:
+            score_field='paragScore_recall_q'
+        
+        if self.dedup_threshold > 0:
+            # duplicates are skipped, so the number of paragraphs needed is unknown in advance
+            sortedParagResult=iter_ranked_paragraphs(sample[score_field])
+        else:
+            sortedParagResult=select_top_paragraphs(sample[score_field], 5)
+        if train:
+            if 'spanScore_f1' in sample:
+                spanScoreRecord=sample['spanScore_f1'][bestspan_idx]
+                fake_span_didx, fake_span_pidx=spanScoreRecord[0], spanScoreRecord[1]
+                sample['answer_spans']=[spanScoreRecord[2]]
+            else:
+                assert 'multi_spanScore_f1' in sample
+                spanScoreRecord=sample['multi_spanScore_f1'][bestspan_idx][0]
+                fake_span_didx, fake_span_pidx=spanScoreRecord[0], spanScoreRecord[1]
+                sample['answer_spans']=[spanScoreRecord[2]]
+
+        odr=-1
+        signatures=[]
+        for paragScoreRecord in sortedParagResult:
+            if len(sample['passages']) >= 5:#取前5?
+                break
+            didx, pidx = paragScoreRecord[0], paragScoreRecord[1]
+            passage_tokens = sample['documents'][didx]['segmented_paragraphs'][pidx]
+            is_fake_span = train and didx==fake_span_didx and pidx==fake_span_pidx
+            if self.dedup_threshold > 0:
+                self.dedup_counts[0] += 1
+                # the span labels are only valid on the exact paragraph of the fake span
+                dup_order, signature = self._find_duplicate(passage_tokens, signatures,
+                                                            exact_only=is_fake_span)
+                if dup_order != -1:
+                    self.dedup_counts[1] += 1
+                    sample['passages'][dup_order]['source_paras'].append([didx, pidx])
+                    if is_fake_span:
+                        odr=dup_order
+                    continue
+                signatures.append(signature)
+            if is_fake_span:
+                odr=len(sample['passages'])
+            if train:
+                sample['passages'].append(
+                        {'passage_tokens': passage_tokens,
+                         'is_selected': sample['documents'][didx]['is_selected'],
+                         'source_paras': [[didx, pidx]]}
+                    )
+            else:
+                sample['passages'].append(
+                        {'passage_tokens': passage_tokens,
+                         'recall_score': paragScoreRecord[2],
+                         'source_paras': [[didx, pidx]]})
+        if odr==-1:
+            if train:
+                passage_tokens = sample['documents'][fake_span_didx]['segmented_paragraphs'][fake_span_pidx]
+                if self.dedup_threshold > 0:
+                    self.dedup_counts[0] += 1
+                    # only an exact duplicate keeps the span labels valid
+                    odr, _ = self._find_duplicate(passage_tokens, signatures, exact_only=True)
+                    if odr != -1:
+                        self.dedup_counts[1] += 1
+                        sample['passages'][odr]['source_paras'].append([fake_span_didx, fake_span_pidx])
+            if train and odr==-1:
+                odr=len(sample['passages'])
+                sample['passages'].append(
+                        {'passage_tokens': passage_tokens,
+                         'is_selected': sample['documents'][fake_span_didx]['is_selected'],
+                         'source_paras': [[fake_span_didx, fake_span_pidx]]}
+                    )
+        sample['fake_span_order']=odr
+        sample.pop('documents')
+        if self.p_window_budget and not self._compress_passages(sample, train):
+            return None
+        return sample
+
+    def bake_sample(self, sample, train=False):
+        """
+        Turns a scored raw sample into its final record: the selected passages truncated to max_p_len,
+        the fake span, fake_span_order, the question tokens and metadata. The baked records are
+        written by utils/preprocess_yhl.py --bake_files and loaded without selecting the passages again
+        Returns:
+            the record, None if the sample should be dropped
+        """
+        sample = self._select_passages(sample, train)
+        if sample is not None:
+            self._slim_sample(sample)
+        return sample
+
+    def _slim_sample(self, sample):
+        """
+        Drops the fields of a sample that are not used after the passage selection (the paragraph
+        and span scores among others), and truncates its passages to max_p_len in place,
+        the original passage lengths are kept
+        """
+        for key in list(sample.keys()):
+            if key not in ['question_id', 'question_type', 'segmented_question', 'answers',
+                           'answer_spans', 'fake_span_order', 'passages']:
+                sample.pop(key)
+        for passage in sample['passages']:
+            passage['orig_passage_len'] = len(passage['passage_tokens'])
+            passage['passage_tokens'] = passage['passage_tokens'][:self.max_p_len]
+
+    def _find_duplicate(self, passage_tokens, signatures, exact_only=False):
+        """
+        Checks whether a passage duplicates one of the selected passages, the exact duplicates
+        share the hash of all tokens, and the near duplicates share at least dedup_threshold
+        (jaccard) of their hashed token trigrams
+        Args:
+            passage_tokens: the tokens of the candidate passage
+            signatures: the signatures of the selected passages, in their order
+            exact_only: if True, the near duplicates are not checked
+        Returns:
+            the order of the duplicated passage (-1 if none) and the signature of this passage
+        """
+        exact_hash = hash(tuple(passage_tokens))
+        shingles = set(hash(tuple(passage_tokens[i: i + 3])) for i in range(max(len(passage_tokens) - 2, 1)))
+        for order, (other_hash, other_shingles) in enumerate(signatures):
+            if exact_hash == other_hash:
+                return order, None
+            if exact_only or self.dedup_threshold >= 1:
+                continue
+            jaccard = 1.0 * len(shingles & other_shingles) / len(shingles | other_shingles)
+            if jaccard >= self.dedup_threshold:
+                return order, None
+        return -1, (exact_hash, shingles)
+
+    def _compress_passages(self, sample, train=False):
+        """
+        Cuts the passages longer than p_window_budget down to the windows with the highest
+        question overlap, the offsets of the kept tokens in the source paragraph (see source_paras)
+        are kept so that the answers are decoded within contiguous windows only
+        Returns:
+            False if the answer span of a train sample can not be kept within max_p_len
+        """
+        question_tokens = set(sample['segmented_question'])
+        for pidx, passage in enumerate(sample['passages']):
+            tokens = passage['passage_tokens']
+            if len(tokens) <= self.p_window_budget:
+                continue
+            window_starts = range(0, len(tokens), self.p_window_size)
+            answer_windows = set()
+            if train and pidx == sample['fake_span_order']:
+                start, end = sample['answer_spans'][0]
+                answer_windows = set(range(start // self.p_window_size, end // self.p_window_size + 1))
+            # the windows of the answer span go first, then by overlap, earlier windows win the ties
+            ranked_windows = sorted(
+                range(len(window_starts)),
+                key=lambda widx: (widx not in answer_windows,
+                                  -sum(1 for token in tokens[window_starts[widx]: window_starts[widx] + self.p_window_size]
+                                       if token in question_tokens),
+                                  widx))
+            kept_windows, kept_len = [], 0
+            for widx in ranked_windows:
+                window_len = min(self.p_window_size, len(tokens) - window_starts[widx])
+                if kept_len + window_len > self.p_window_budget and widx not in answer_windows:
+                    continue
+                kept_windows.append(widx)
+                kept_len += window_len
+            token_offsets = []
+            for widx in sorted(kept_windows):
+                token_offsets += range(window_starts[widx], min(window_starts[widx] + self.p_window_size, len(tokens)))
+            passage['token_offsets'] = token_offsets
+            passage['passage_tokens'] = [tokens[offset] for offset in token_offsets]
+            if answer_windows:
+                start, end = sample['answer_spans'][0]
+                sample['answer_spans'] = [[token_offsets.index(start), token_offsets.index(end)]]
+        if train and sample['answer_spans'][0][1] >= self.max_p_len:
+            return False
+        return True
+
+    def sample_dev_subset(self, sample_num, seed=0):
+        """
+        Draws a fixed dev subset stratified by source (search/zhidao) x question_type,
+        every stratum keeps its share of the full dev set
+        Args:
+            sample_num: approximate number of questions in the subset
+            seed: random seed, the same seed always gives the same subset
+        Returns:
+            the subset, also kept as self.dev_subset
+        """
+        strata = {}
+        for idx, sample in enumerate(self.dev_set):
+            strata.setdefault((self.dev_sources[idx], sample['question_type']), []).append(idx)
+        ratio = min(1.0, 1.0 * sample_num / max(len(self.dev_set), 1))
+        rng = np.random.RandomState(seed)
+        selected = []
+        for key in sorted(strata.keys()):
+            stratum = strata[key]
+            stratum_num = max(1, int(round(len(stratum) * ratio)))
+            selected += rng.choice(stratum, stratum_num, replace=False).tolist()
+        self.dev_subset = [self.dev_set[idx] for idx in sorted(selected)]
+        self.logger.info('Dev subset size: {} questions from {} strata.'.format(
+            len(self.dev_subset), len(strata)))
+        return self.dev_subset
+
+    def apply_passage_cascade(self, threshold, set_names=('dev', 'test')):
+        """
+        Trims the passages of each sample before they are fed to the model, the passages are
+        already sorted by paragScore_recall_q, and only the top ones that cover threshold of the
+        total recall score are kept, so a sample with one dominating passage keeps only that one
+        Args:
+            threshold: a float in (0, 1], 1 keeps all passages
+            set_names: the sets to be trimmed, train set is never trimmed
+        Returns:
+            number of passages before and after trimming
+        """
+        total_num, kept_num = 0, 0
+        for set_name in set_names:
+            data_set = self.dev_set if set_name == 'dev' else self.test_set
+            for sample in data_set:
+                passages = sample['passages'][:self.max_p_num]
+                scores = [passage.get('recall_score', 0) for passage in passages]
+                score_sum, keep_num = sum(scores), len(passages)
+                if score_sum > 0:
+                    covered = 0
+                    for pidx, score in enumerate(scores, 1):
+                        covered += score
+                        if covered >= threshold * score_sum:
+                            keep_num = pidx
+                            break
+                sample['passages'] = passages[:keep_num]
+                total_num += len(passages)
+                kept_num += keep_num
+        self.logger.info('Passage cascade with threshold {} keeps {} of {} passages.'.format(
+            threshold, kept_num, total_num))
+        return total_num, kept_num
+
     def _one_mini_batch(self, data, indices, pad_id):
         """
         Get one mini batch
@@ -152,6 +472,10 @@ class BRCDataset(object):
                       'passage_length': [],
                       'start_id': [],
                       'end_id': []}
+        if self.lazy_raw_data:
+            batch_data['load_raw_data'] = self.load_raw_samples
+        if self.pack_len > 0:
+            return self._packed_mini_batch(batch_data, pad_id)
         max_passage_num = max([len(sample['passages']) for sample in batch_data['raw_data']])
         max_passage_num = min(self.max_p_num, max_passage_num)#TODO
         for sidx, sample in enumerate(batch_data['raw_data']):
@@ -170,15 +494,67 @@ class BRCDataset(object):
         batch_data, padded_p_len, padded_q_len = self._dynamic_padding(batch_data, pad_id)
         for sample in batch_data['raw_data']:
             # if 'answer_docs' in sample and len(sample['answer_docs']):
-            if sample['fake_span_order']!=-1:
-                # gold_passage_offset = padded_p_len * sample['answer_docs'][0]
-                gold_passage_offset = padded_p_len * sample['fake_span_order']
-                batch_data['start_id'].append(gold_passage_offset + sample['answer_spans'][0][0])
-                batch_data['end_id'].append(gold_passage_offset + sample['answer_spans'][0][1])
-            else:
-                # fake span for some samples, only valid for testing-----TODO and evaluate...
-                batch_data['start_id'].append(0)
-                batch_data['end_id'].append(0)
+            # gold_passage_offset = padded_p_len * sample['answer_docs'][0]
+            self._append_span_labels(batch_data, sample, [padded_p_len * pidx for pidx in range(max_passage_num)])
+        return batch_data
+
+    def _append_span_labels(self, batch_data, sample, passage_starts):
+        """
+        Appends the start and end labels of a sample, passage_starts gives the position of each
+        fed passage in the concatenated rows of the sample. A sample whose gold passage is beyond
+        max_p_num gets -1 labels, whose one-hot vectors are empty, so it adds nothing to the loss
+        """
+        if sample['fake_span_order'] == -1:
+            # fake span for some samples, only valid for testing-----TODO and evaluate...
+            batch_data['start_id'].append(0)
+            batch_data['end_id'].append(0)
+        elif sample['fake_span_order'] >= len(passage_starts):
+            batch_data['start_id'].append(-1)
+            batch_data['end_id'].append(-1)
+        else:
+            gold_passage_offset = passage_starts[sample['fake_span_order']]
+            batch_data['start_id'].append(gold_passage_offset + sample['answer_spans'][0][0])
+            batch_data['end_id'].append(gold_passage_offset + sample['answer_spans'][0][1])
+
+    def _packed_mini_batch(self, batch_data, pad_id):
+        """
+        Fills one mini batch whose passages are packed, the passages of a sample are concatenated
+        into rows of up to pack_len tokens instead of one padded row each. segment_ids tells the
+        passages of a row apart (pidx + 1, 0 for padding) so that the model keeps them separate,
+        and passage_starts gives the position of each passage in the concatenated rows of its sample
+        """
+        packed_samples = []
+        for sample in batch_data['raw_data']:
+            rows, starts = [], []
+            for pidx, passage in enumerate(sample['passages'][:self.max_p_num]):
+                passage_token_ids = passage['passage_token_ids'][:self.max_p_len]
+                # first fit: the first row with room for the passage
+                ridx = 0
+                while ridx < len(rows) and len(rows[ridx][0]) + len(passage_token_ids) > self.pack_len:
+                    ridx += 1
+                if ridx == len(rows):
+                    rows.append(([], []))
+                row_token_ids, row_segment_ids = rows[ridx]
+                starts.append((ridx, len(row_token_ids)))
+                row_token_ids.extend(passage_token_ids)
+                row_segment_ids.extend([pidx + 1] * len(passage_token_ids))
+            packed_samples.append((rows, starts))
+        row_num = max([len(rows) for rows, _ in packed_samples] + [1])
+        pad_p_len = max([len(row[0]) for rows, _ in packed_samples for row in rows] + [1])
+        pad_q_len = min(self.max_q_len, max([len(sample['question_token_ids']) for sample in batch_data['raw_data']]))
+        batch_data['segment_ids'], batch_data['passage_starts'] = [], []
+        for sample, (rows, starts) in zip(batch_data['raw_data'], packed_samples):
+            for ridx in range(row_num):
+                row_token_ids, row_segment_ids = rows[ridx] if ridx < len(rows) else ([], [])
+                question_token_ids = sample['question_token_ids'][:pad_q_len] if row_token_ids else []
+                batch_data['question_token_ids'].append(question_token_ids + [pad_id] * (pad_q_len - len(question_token_ids)))
+                batch_data['question_length'].append(len(question_token_ids))
+                batch_data['passage_token_ids'].append(row_token_ids + [pad_id] * (pad_p_len - len(row_token_ids)))
+                batch_data['passage_length'].append(len(row_token_ids))
+                batch_data['segment_ids'].append(row_segment_ids + [0] * (pad_p_len - len(row_segment_ids)))
+            passage_starts = [ridx * pad_p_len + offset for ridx, offset in starts]
+            batch_data['passage_starts'].append(passage_starts)
+            self._append_span_labels(batch_data, sample, passage_starts)
         return batch_data
 
     def _dynamic_padding(self, batch_data, pad_id):
@@ -219,28 +595,212 @@ class BRCDataset(object):
                     for token in passage['passage_tokens']:
                         yield token
 
-    def convert_to_ids(self, vocab):
+    def sample_tokens(self, sample, train=False):
+        """
+        The tokens word_iter would give for a raw sample once it is loaded,
+        for counting the vocab straight from the data files, see utils.count_tokens
+        Returns:
+            a list of tokens, None if the sample would be dropped
+        """
+        sample = self._select_passages(sample, train)
+        if sample is None:
+            return None
+        if self.slim_load:
+            self._slim_sample(sample)
+        tokens = list(sample['segmented_question'])
+        for passage in sample['passages']:
+            tokens += passage['passage_tokens']
+        return tokens
+
+    def convert_to_ids(self, vocab, processes=1):
         """
-        Convert the question and passage in the original dataset to ids
+        Convert the question and passage in the original dataset to ids,
+        all the token lists of a set are converted in one batch
         Args:
             vocab: the vocabulary on this dataset
+            processes: the number of processes converting the batch
         """
+        self.vocab_hash = vocab.token_hash()
         for data_set in [self.train_set, self.dev_set, self.test_set]:
             if data_set is None:
                 continue
+            token_lists = []
             for sample in data_set:
-                sample['question_token_ids'] = vocab.convert_to_ids(sample['segmented_question'])
+                token_lists.append(sample['segmented_question'])
                 for passage in sample['passages']:
-                    passage['passage_token_ids'] = vocab.convert_to_ids(passage['passage_tokens'])
+                    token_lists.append(passage['passage_tokens'])
+            ids, offsets = vocab.convert_batch_to_ids(token_lists, processes=processes)
+            # the fields stay python lists, the batches are padded by list concatenation
+            ids, offsets = ids.tolist(), offsets.tolist()
+            list_idx = 0
+            for sample in data_set:
+                sample['question_token_ids'] = ids[offsets[list_idx]: offsets[list_idx + 1]]
+                list_idx += 1
+                for passage in sample['passages']:
+                    passage['passage_token_ids'] = ids[offsets[list_idx]: offsets[list_idx + 1]]
+                    list_idx += 1
+                if 'raw_location' in sample:
+                    self._compact_sample(sample)
+
+    def _compact_sample(self, sample):
+        """
+        Drops the text fields of a sample in place, load_raw_samples brings them back
+        """
+        for key in list(sample.keys()):
+            if key not in ['question_id', 'question_type', 'question_token_ids', 'passages',
+                           'fake_span_order', 'answer_spans', 'raw_location']:
+                sample.pop(key)
+        for passage in sample['passages']:
+            for key in list(passage.keys()):
+                if key not in ['passage_token_ids', 'recall_score']:
+                    passage.pop(key)
 
-    def gen_mini_batches(self, set_name, batch_size, pad_id, shuffle=True):
+    def load_raw_samples(self, samples):
+        """
+        Parses the full samples again from their source files, for the compact samples
+        Args:
+            samples: a list of samples, the ones that are not compact are returned as they are
+        Returns:
+            a list of full samples, with the same passages as the compact ones
+        """
+        raw_samples, fins = [], {}
+        for sample in samples:
+            if 'raw_location' not in sample:
+                raw_samples.append(sample)
+                continue
+            raw_file_idx, offset = sample['raw_location']
+            data_path, train = self.raw_files[raw_file_idx]
+            if raw_file_idx not in fins:
+                fins[raw_file_idx] = open(data_path, 'rb')
+            fins[raw_file_idx].seek(offset)
+            raw_sample = self._select_passages(json.loads(fins[raw_file_idx].readline().strip()), train)
+            # the passages may have been trimmed after loading, e.g. by the passage cascade
+            raw_sample['passages'] = raw_sample['passages'][:len(sample['passages'])]
+            raw_samples.append(raw_sample)
+        for fin in fins.values():
+            fin.close()
+        return raw_samples
+
+    def publish_shared(self, shared_dir, set_names=('train', 'dev')):
+        """
+        Writes the compact samples of some sets as arrays that concurrent trainers memory-map
+        with attach_shared, must be called after convert_to_ids with lazy_raw_data, the text
+        fields are parsed again from the raw files when evaluating. The arrays are written
+        to a temporary directory renamed to shared_dir, so a partial dataset is never attached
+        Args:
+            shared_dir: the directory to publish to, nothing is written if it already exists
+            set_names: the sets to publish
+        """
+        if os.path.exists(shared_dir):
+            self.logger.info('{} is already published.'.format(shared_dir))
+            return
+        tmp_dir = '{}.tmp{}'.format(shared_dir.rstrip('/'), os.getpid())
+        os.makedirs(tmp_dir)
+        question_types = []
+        meta = {'raw_files': [(os.path.abspath(data_path), train) for data_path, train in self.raw_files],
+                'dev_sources': self.dev_sources, 'set_sizes': {},
+                'vocab_hash': self.vocab_hash, 'options': self._shared_options()}
+        for set_name in set_names:
+            data_set = self.train_set if set_name == 'train' else self.dev_set
+            arrays = {field: [] for field in SHARED_FIELDS}
+            question_offsets, sample_offsets, passage_offsets = [0], [0], [0]
+            for sample in data_set:
+                if 'raw_location' not in sample:
+                    shutil.rmtree(tmp_dir)
+                    raise ValueError('Only the samples loaded with lazy_raw_data from uncompressed files '
+                                     'can be published, {} is not.'.format(sample['question_id']))
+                if sample['question_type'] not in question_types:
+                    question_types.append(sample['question_type'])
+                arrays['question_ids'].append(sample['question_id'])
+                arrays['question_type_ids'].append(question_types.index(sample['question_type']))
+                arrays['question_token_ids'] += sample['question_token_ids']
+                question_offsets.append(len(arrays['question_token_ids']))
+                for passage in sample['passages']:
+                    arrays['passage_ids'] += passage['passage_token_ids']
+                    passage_offsets.append(len(arrays['passage_ids']))
+                    arrays['recall_scores'].append(passage.get('recall_score', np.nan))
+                sample_offsets.append(len(passage_offsets) - 1)
+                arrays['fake_span_orders'].append(sample['fake_span_order'])
+                answer_spans = sample.get('answer_spans', [])
+                arrays['answer_spans'].append(answer_spans[0] if answer_spans else [-1, -1])
+                arrays['raw_locations'].append(sample['raw_location'])
+            arrays['question_offsets'], arrays['sample_offsets'] = question_offsets, sample_offsets
+            arrays['passage_offsets'] = passage_offsets
+            dtypes = {'question_token_ids': np.int32, 'passage_ids': np.int32, 'recall_scores': np.float64,
+                      'question_type_ids': np.int8, 'fake_span_orders': np.int32, 'answer_spans': np.int32}
+            for field in SHARED_FIELDS:
+                array = np.array(arrays[field], dtype=dtypes.get(field, np.int64))
+                if field == 'answer_spans' or field == 'raw_locations':
+                    array = array.reshape(-1, 2)
+                np.save(os.path.join(tmp_dir, '{}_{}.npy'.format(set_name, field)), array)
+            meta['set_sizes'][set_name] = len(data_set)
+        meta['question_types'] = question_types
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as fout:
+            json.dump(meta, fout)
+        try:
+            os.rename(tmp_dir, shared_dir)
+        except OSError:
+            # another trainer published it first
+            shutil.rmtree(tmp_dir)
+        self.logger.info('Published {} to {}.'.format(', '.join(set_names), shared_dir))
+
+    def attach_shared(self, shared_dir, vocab_hash):
+        """
+        Replaces the sets of this dataset by the memory-mapped ones published in shared_dir,
+        only the batch index permutations are allocated by this process then
+        Args:
+            shared_dir: the directory written by publish_shared
+            vocab_hash: the token_hash of the vocab of this trainer, the ids must come from the same vocab
+        Returns:
+            False if nothing is published in shared_dir yet, raises a ValueError if the samples
+            were published with another vocab or other options
+        """
+        meta_path = os.path.join(shared_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path) as fin:
+            meta = json.load(fin)
+        if meta.get('vocab_hash') != vocab_hash:
+            raise ValueError('{} was converted with another vocab, of token hash {}, not {}.'.format(
+                shared_dir, meta.get('vocab_hash'), vocab_hash))
+        if meta['options'] != self._shared_options():
+            # the raw samples would be selected again with other options than the shared ids
+            raise ValueError('{} was published with the options {}, not {}.'.format(
+                shared_dir, meta['options'], self._shared_options()))
+        self.raw_files = [tuple(raw_file) for raw_file in meta['raw_files']]
+        self.lazy_raw_data = True
+        self.dev_sources = meta['dev_sources']
+        for set_name in meta['set_sizes']:
+            shared_samples = SharedSamples(shared_dir, set_name, meta['question_types'])
+            if set_name == 'train':
+                self.train_set = shared_samples
+            else:
+                self.dev_set = shared_samples
+        self.logger.info('Attached to {}: {}.'.format(shared_dir, ', '.join(
+            '{} {} questions'.format(set_name, size) for set_name, size in sorted(meta['set_sizes'].items()))))
+        return True
+
+    def _shared_options(self):
+        """
+        The options that change the published samples
+        """
+        return {'max_p_num': self.max_p_num, 'max_p_len': self.max_p_len, 'max_q_len': self.max_q_len,
+                'p_window_budget': self.p_window_budget, 'p_window_size': self.p_window_size,
+                'dedup_threshold': self.dedup_threshold, 'slim_load': self.slim_load}
+
+    def gen_mini_batches(self, set_name, batch_size, pad_id, shuffle=True, seed=None, start_batch=0,
+                         sort_by_length=False):
         """
         Generate data batches for a specific dataset (train/dev/test)
         Args:
-            set_name: train/dev/test to indicate the set
+            set_name: train/dev/test/dev_subset to indicate the set
             batch_size: number of samples in one batch
             pad_id: pad id
             shuffle: if set to be true, the data is shuffled.
+            seed: if set, the shuffle permutation is determined by it
+            start_batch: number of leading batches to skip, used to resume an epoch
+            sort_by_length: if true, the samples are batched in order of padded size instead,
+                            the indices of a batch give the positions of its samples in the set
         Returns:
             a generator for all batches
         """
@@ -250,12 +810,30 @@ class BRCDataset(object):
             data = self.dev_set
         elif set_name == 'test':
             data = self.test_set
+        elif set_name == 'dev_subset':
+            data = self.dev_subset
         else:
             raise NotImplementedError('No data set named as {}'.format(set_name))
         data_size = len(data)
         indices = np.arange(data_size)
-        if shuffle:
-            np.random.shuffle(indices)
-        for batch_start in np.arange(0, data_size, batch_size):
+        if sort_by_length:
+            indices = np.array(sorted(indices, key=lambda idx: self._padded_size(data[idx])), dtype=np.int64)
+        elif shuffle:
+            if seed is None:
+                np.random.shuffle(indices)
+            else:
+                np.random.RandomState(seed).shuffle(indices)
+        for batch_start in np.arange(start_batch * batch_size, data_size, batch_size):
             batch_indices = indices[batch_start: batch_start + batch_size]
-            yield self._one_mini_batch(data, batch_indices, pad_id)
+            batch_data = self._one_mini_batch(data, batch_indices, pad_id)
+            batch_data['indices'] = batch_indices.tolist()
+            yield batch_data
+
+    def _padded_size(self, sample):
+        """
+        The key of a sample when sorting by length: its longest fed passage,
+        then the number of its fed passages and the length of its question
+        """
+        passages = sample['passages'][:self.max_p_num]
+        max_passage_len = max([len(passage['passage_token_ids']) for passage in passages] + [0])
+        return (min(max_passage_len, self.max_p_len), len(passages), min(len(sample['question_token_ids']), self.max_q_len))
@@ -110,12 +110,61 @@ def bilstm(inputs, lengths, hidden_size, layer_num=1):
     return outputs, _
 
 def bilstm_layer(inputs, lengths, hidden_size, layer_num=1):
-    cell = keras.layers.CuDNNLSTM(hidden_size, kernel_initializer='glorot_uniform', recurrent_initializer='orthogonal',
-                                  bias_initializer='zeros',unit_forget_bias=True, return_sequences=True,
-                                  return_state=True)
-    bicell = keras.layers.Bidirectional(cell)
-    outputs = bicell(inputs)
-    return outputs[0], outputs[1:]
+    """
+    Implements the Bi-LSTM with CuDNN, which knows nothing of the lengths: the backward direction
+    runs on the rows reversed within their lengths, so the padding at the end of a row is read
+    after its tokens in both directions and the outputs of the tokens do not depend on it
+    Args:
+        inputs: padded inputs, [batch, len, dim]
+        lengths: the valid length of the rows
+        hidden_size: the size of hidden units
+    Returns:
+        the concatenated forward and backward outputs, and the states of the two directions
+    """
+    def cudnn_lstm():
+        return keras.layers.CuDNNLSTM(hidden_size, kernel_initializer='glorot_uniform',
+                                      recurrent_initializer='orthogonal', bias_initializer='zeros',
+                                      unit_forget_bias=True, return_sequences=True, return_state=True)
+    fw_outputs = cudnn_lstm()(inputs)
+    bw_outputs = cudnn_lstm()(tf.reverse_sequence(inputs, lengths, seq_axis=1, batch_axis=0))
+    outputs = tf.concat([fw_outputs[0], tf.reverse_sequence(bw_outputs[0], lengths, seq_axis=1, batch_axis=0)], -1)
+    return outputs, fw_outputs[1:] + bw_outputs[1:]
+
+
+
+def segment_bilstm_layer(inputs, segment_ids, hidden_size):
+    """
+    Implements the Bi-LSTM over packed rows with the same layer as the passage rows, the segments
+    are unpacked into one row per passage around the layer and packed back after it,
+    so that every passage of a row is encoded as if it were alone in its row
+    Args:
+        inputs: packed inputs, [batch, row_len, dim]
+        segment_ids: the segment of each position, 0 for padding, which is at the end of the rows
+        hidden_size: the size of hidden units
+    Returns:
+        the concatenated forward and backward outputs, [batch, row_len, 2 * hidden_size]
+    """
+    # the (row, position) of every token, in row major order the tokens of a segment are contiguous
+    positions = tf.where(segment_ids > 0)
+    rows, cols = positions[:, 0], positions[:, 1]
+    segment_num = tf.cast(tf.reduce_max(segment_ids) + 1, tf.int64)
+    segment_keys = rows * segment_num + tf.cast(tf.gather_nd(segment_ids, positions), tf.int64)
+    _, passage_idx = tf.unique(segment_keys, out_idx=tf.int64)
+    passage_starts = tf.segment_min(cols, passage_idx)
+    passage_positions = tf.stack([passage_idx, cols - tf.gather(passage_starts, passage_idx)], 1)
+    passage_length = tf.cast(tf.segment_sum(tf.ones_like(cols), passage_idx), tf.int32)
+
+    dim = inputs.get_shape().as_list()[-1]
+    passage_shape = tf.stack([tf.reduce_max(passage_idx) + 1, tf.cast(tf.reduce_max(passage_length), tf.int64),
+                              tf.constant(dim, tf.int64)])
+    passage_inputs = tf.scatter_nd(passage_positions, tf.gather_nd(inputs, positions), passage_shape)
+    passage_inputs.set_shape([None, None, dim])
+    passage_outputs, _ = bilstm_layer(passage_inputs, passage_length, hidden_size)
+
+    packed_shape = tf.concat([tf.shape(segment_ids, out_type=tf.int64), tf.constant([2 * hidden_size], tf.int64)], 0)
+    outputs = tf.scatter_nd(positions, tf.gather_nd(passage_outputs, passage_positions), packed_shape)
+    outputs.set_shape([None, None, 2 * hidden_size])
+    return outputs, None
 
 
 class _CudnnRnn(object):
@@ -78,6 +78,21 @@ class MatchLSTMLayer(object):
         return match_outputs, match_state
 
 
+def padding_mask(lengths, max_len):
+    """
+    The [batch, max_len] logits mask, 0 for the valid positions and -1e9 for the padding
+    """
+    return -1e9 * (1.0 - tf.sequence_mask(lengths, max_len, dtype=tf.float32))
+
+
+def segment_mask(segment_ids):
+    """
+    The [batch, row_len, row_len] mask of the position pairs in the same segment of a packed row
+    """
+    same_segment = tf.equal(tf.expand_dims(segment_ids, 2), tf.expand_dims(segment_ids, 1))
+    return tf.cast(tf.logical_and(same_segment, tf.expand_dims(segment_ids > 0, 2)), tf.float32)
+
+
 class AttentionFlowMatchLayer(object):
     """
     Implements the Attention Flow layer,
@@ -87,9 +102,11 @@ class AttentionFlowMatchLayer(object):
     def __init__(self, hidden_size):
         self.hidden_size = hidden_size
 
-    def match(self, passage_encodes, question_encodes, hidden_size):
+    def match(self, passage_encodes, question_encodes, p_length, q_length, segment_ids=None):
         """
-        Match the passage_encodes with question_encodes using Attention Flow Match algorithm
+        Match the passage_encodes with question_encodes using Attention Flow Match algorithm,
+        for packed rows the question-to-context attention is computed within each segment,
+        the padding of the passages and of the questions is never attended to
         """
         with tf.variable_scope('bidaf'):
             #bilstm不能直接连接dense AttributeError: 'Bidirectional' object has no attribute 'outbound_nodes'
@@ -103,10 +120,17 @@ class AttentionFlowMatchLayer(object):
             sim_matrix = dot_sim_matrix + tf.expand_dims(passage_sim, 2) + tf.expand_dims(question_sim, 1)
             # sim_matrix = tf.matmul(passage_encodes, question_encodes, transpose_b=True)
 
+            sim_matrix = sim_matrix + tf.expand_dims(padding_mask(q_length, tf.shape(question_encodes)[1]), 1)
+
             context2question_attn = tf.matmul(tf.nn.softmax(sim_matrix, -1), question_encodes)
-            b = tf.nn.softmax(tf.expand_dims(tf.reduce_max(sim_matrix, 2), 1), -1)
-            question2context_attn = tf.tile(tf.matmul(b, passage_encodes),
-                                            [1, tf.shape(passage_encodes)[1], 1])
+            if segment_ids is None:
+                b = tf.expand_dims(tf.reduce_max(sim_matrix, 2) + padding_mask(p_length, tf.shape(passage_encodes)[1]), 1)
+                question2context_attn = tf.tile(tf.matmul(tf.nn.softmax(b, -1), passage_encodes),
+                                                [1, tf.shape(passage_encodes)[1], 1])
+            else:
+                # every position attends to the positions of its own segment only
+                b = tf.expand_dims(tf.reduce_max(sim_matrix, 2), 1) + -1e9 * (1.0 - segment_mask(segment_ids))
+                question2context_attn = tf.matmul(tf.nn.softmax(b, -1), passage_encodes)
             concat_outputs = tf.concat([passage_encodes, context2question_attn,
                                         passage_encodes * context2question_attn,
                                         passage_encodes * question2context_attn], -1)
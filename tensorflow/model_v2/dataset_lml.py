@@ -23,6 +23,11 @@ import json
 import logging
 import numpy as np
 from collections import Counter
+import sys
+# the root utils dir, the utils package of the model variants has no file_utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'utils'))
+from file_utils import open_file
+from paragraph_selection import load_top_paragraph_ids, gather_paragraphs
 #改进:训练集用baseline，search的开发集和测试集选用了多特征在问题和篇章之间匹配选篇章，zhidao仍用baseline
 
 class BRCDataset(object):
@@ -66,7 +71,7 @@ class BRCDataset(object):
         Args:
             data_path: the data file to load
         """
-        with open(data_path) as fin:
+        with open_file(data_path) as fin:
             data_set = []
             for lidx, line in enumerate(fin):
                 sample = json.loads(line.strip())
@@ -109,32 +114,28 @@ class BRCDataset(object):
     def _load_dataset_search(self, data_path, top5Pid_path, train=False):
         
         """
-        Loads the dataset
+        Loads the dataset, the selected paragraphs are joined by question_id
         Args:
-            data_path: the data file to load
+            data_path: the data file to load, or a file pre-joined by join_top5_paragraphs
+            top5Pid_path: the top5_para_ids file written by lr_predict_forTOP5,
+                          not needed for a pre-joined data file
         """
-        with open(data_path) as fin:
-            with open(top5Pid_path,'r') as fr:
-                data_set = []
-                for lidx, line in enumerate(fin):#读取一个样本
-                    sample = json.loads(line.strip())
-                    if len(sample['documents'])!=0:
-                        top5Pids=json.loads(fr.readline())
-                        assert top5Pids['question_id']==sample['question_id']
-                    
-                    sample['passages'] = []
-                    
-                    for d_idx, doc in enumerate(sample['documents']):
-                        for p_idx, para_tokens in enumerate(doc['segmented_paragraphs']):
-                            for top5Pid in top5Pids['top5_para_ids']:
-                                if d_idx==top5Pid[0] and p_idx==top5Pid[1]:
-                                    sample['passages'].append({'passage_tokens': para_tokens})
-                    
-                    if len(sample['documents'])!=0:
-                        assert len(sample['passages'])==len(top5Pids['top5_para_ids'])
-
-                    sample.pop('documents')
+        top5Pids = load_top_paragraph_ids(top5Pid_path) if top5Pid_path else {}
+        with open_file(data_path) as fin:
+            data_set = []
+            for lidx, line in enumerate(fin):#读取一个样本
+                sample = json.loads(line.strip())
+                if 'documents' not in sample:#已经预先拼接好的样本
                     data_set.append(sample)
+                    continue
+
+                sample['passages'] = []
+                if len(sample['documents'])!=0:
+                    for para_tokens in gather_paragraphs(sample['documents'], top5Pids[sample['question_id']]):
+                        sample['passages'].append({'passage_tokens': para_tokens})
+
+                sample.pop('documents')
+                data_set.append(sample)
         return data_set
 
     def _one_mini_batch(self, data, indices, pad_id):
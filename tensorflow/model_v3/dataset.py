@@ -23,6 +23,11 @@ import json
 import logging
 import numpy as np
 from collections import Counter
+import sys
+# the root utils dir, the utils package of the model variants has no file_utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'utils'))
+from file_utils import open_file
+from paragraph_selection import select_top_paragraphs
 ##改进：全局选择most_related_paras（5个） 和 fake_span（1个）
 
 class BRCDataset(object):
@@ -58,7 +63,7 @@ class BRCDataset(object):
         Args:
             data_path: the data file to load
         """
-        with open(data_path) as fin:
+        with open_file(data_path) as fin:
             data_set = []
             for lidx, line in enumerate(fin):
                 sample = json.loads(line.strip())
@@ -93,13 +98,7 @@ class BRCDataset(object):
                 else:
                     score_field='paragScore_recall_q'
                 
-                paragScoreRecords=[]
-                
-                
-                for k,v in sample[score_field].items():
-                    for item in v:
-                        paragScoreRecords.append((k,item[0],item[1]))
-                sortedParagResult=sorted(paragScoreRecords, key=lambda record: record[-1],reverse=True)
+                sortedParagResult=select_top_paragraphs(sample[score_field], 5)
                 if train:
                     if 'spanScore_f1' in sample:
                         spanScoreRecord=sample['spanScore_f1'][bestspan_idx]
@@ -112,17 +111,17 @@ class BRCDataset(object):
                         sample['answer_spans']=[spanScoreRecord[2]]
 
                 odr=-1
-                for r_idx, paragScoreRecord in enumerate(sortedParagResult[:5]):#取前5?
-                    if train and int(paragScoreRecord[0])==fake_span_didx and paragScoreRecord[1]==fake_span_pidx:
+                for r_idx, paragScoreRecord in enumerate(sortedParagResult):#取前5?
+                    if train and paragScoreRecord[0]==fake_span_didx and paragScoreRecord[1]==fake_span_pidx:
                         odr=r_idx
                     if train:
                         sample['passages'].append(
-                                {'passage_tokens': sample['documents'][int(paragScoreRecord[0])]['segmented_paragraphs'][paragScoreRecord[1]],
-                                 'is_selected': sample['documents'][int(paragScoreRecord[0])]['is_selected']}
+                                {'passage_tokens': sample['documents'][paragScoreRecord[0]]['segmented_paragraphs'][paragScoreRecord[1]],
+                                 'is_selected': sample['documents'][paragScoreRecord[0]]['is_selected']}
                             )
                     else:
                         sample['passages'].append(
-                                {'passage_tokens': sample['documents'][int(paragScoreRecord[0])]['segmented_paragraphs'][paragScoreRecord[1]]})
+                                {'passage_tokens': sample['documents'][paragScoreRecord[0]]['segmented_paragraphs'][paragScoreRecord[1]]})
                 if odr==-1:
                     if train:
                         odr=5
@@ -23,6 +23,10 @@ import json
 import logging
 import numpy as np
 from collections import Counter
+import sys
+# the root utils dir, the utils package of the model variants has no file_utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'utils'))
+from file_utils import open_file
 
 
 class BRCDataset(object):
@@ -85,7 +89,7 @@ class BRCDataset(object):
         Args:
             data_path: the data file to load
         """
-        with open(data_path) as fin:
+        with open_file(data_path) as fin:
             data_set = []
             for lidx, line in enumerate(fin):
                 sample = json.loads(line.strip())
@@ -129,7 +133,7 @@ class BRCDataset(object):
         Args:
             data_path: the data file to load
         """
-        with open(data_path) as fin:
+        with open_file(data_path) as fin:
             data_set = []
             for lidx, line in enumerate(fin):
                 sample = json.loads(line.strip())
@@ -23,6 +23,11 @@ import json
 import logging
 import numpy as np
 from collections import Counter
+import sys
+# the root utils dir, the utils package of the model variants has no file_utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'utils'))
+from file_utils import open_file
+from paragraph_selection import iter_ranked_paragraphs
 
 ##改进v2: 训练集用全局选的para和span，但是开发集和测试集仍然按baseline方法
 ##改进multispan: 多篇章训练，预处理得到每个sample多个fake_span(至多3个)，形成训练数据时，1正，3top para，1顺次选，形成样本
@@ -41,6 +46,8 @@ class BRCDataset(object):
         # f1_thresholds=[0.75, 0.8]#f1_threshold for search and zhidao
         f1_thresholds=[0.85, 0.9]#f1_threshold for search and zhidao
         self.train_set, self.dev_set, self.test_set = [], [], []
+        # train samples are lightweight groups over the passage pools of their questions
+        self.train_pools = []
 
         if train_files:
             for train_file, multiSpan_file, threshold in zip(train_files, multiSpan_files, f1_thresholds):
@@ -63,98 +70,142 @@ class BRCDataset(object):
         Args:
             data_globalPara_path: the data file to load
         """
-        multiSpanRecords={}
-        with open(data_globalMultiSpan_path) as fin_multiSpan:
-            for line in fin_multiSpan:
-                multiSpanRecord = json.loads(line.strip())
-                multiSpanRecords[multiSpanRecord['question_id']]=multiSpanRecord
-        # print('len(multiSpanRecords)', len(multiSpanRecords))#136208
+        data_set = []
+        for sample, multiSpanRecord in self._join_multi_span_records(data_globalPara_path,
+                                                                     data_globalMultiSpan_path):
+            idx_toremove=[]
+            for idx, spanScore in enumerate(multiSpanRecord['multi_spanScore_f1']):
+                if spanScore[2][1]>= self.max_p_len or spanScore[-1]<threshold:
+                    idx_toremove.append(idx)
+            multiSpanRecord['multi_spanScore_f1']=[item for i,item in enumerate(multiSpanRecord['multi_spanScore_f1']) if i not in idx_toremove]
+            
+            ans_para_num=len(multiSpanRecord['multi_spanScore_f1'])#会形成的样本个数~
 
-        with open(data_globalPara_path) as fin_para:
-            data_set = []
+            if ans_para_num==0:
+                continue
+            
+            # the passages of all the groups of a sample live once in its pool,
+            # a group only holds the indices of its passages in the pool
+            pool={'question_id': sample['question_id'],
+                  'segmented_question': sample['segmented_question'],
+                  'passages': []}
+            pool_index_of={}
+            passages_group=[]
+            fake_ans_record_group=[]
+            for i in range(ans_para_num):
+                passages_group.append([])
+                fake_ans_record_group.append(())
+            group_idx_pos=0#标示 找到的fake_span所在passage送入的group
+            group_idx_neg=0#标示 找到的负例送入的group
+            
+            sortedParagResult=iter_ranked_paragraphs(sample['paragScore_recall_a'])
+            pos_num=0
+            for r_idx, paragScoreRecord in enumerate(sortedParagResult):
+                is_pos=False#每篇passage初始化为不是正例
+                #首先判断是否是正例，若是，则放入指定的group，并不再作为负例
+                for psg_idx, spanScore in enumerate(multiSpanRecord['multi_spanScore_f1']):
+                    if paragScoreRecord[0]==spanScore[0] and paragScoreRecord[1]==spanScore[1] and group_idx_pos<ans_para_num:
+                        is_pos=True
+                        if group_idx_pos<ans_para_num:#每组只会增加一个额外正例
+                            passages_group[group_idx_pos].append(
+                                self._pool_passage(pool, pool_index_of, sample, paragScoreRecord))
+                            fake_ans_record_group[group_idx_pos]=(len(passages_group[group_idx_pos])-1, spanScore[2])
+                            group_idx_pos+=1
+                if is_pos:
+                    pos_num+=1
+                #作为负例加入相应的group-(1)首先是否属于top3 负例
+                if is_pos==False:
+                    if r_idx+1 - pos_num<3:#说明该篇章属于top3负例（当前总passage数-属于正例passage数）
+                        for group_idx in range(ans_para_num):
+                            passages_group[group_idx].append(
+                                self._pool_passage(pool, pool_index_of, sample, paragScoreRecord))
+                    else:
+                        if group_idx_neg<ans_para_num:#每组只会增加一个额外负例
+                            passages_group[group_idx_neg].append(
+                                self._pool_passage(pool, pool_index_of, sample, paragScoreRecord))
+                            group_idx_neg+=1
+                if group_idx_pos==ans_para_num and group_idx_neg==ans_para_num:#每组已经找够了
+                    break
+
+            self.train_pools.append(pool)
+            for p_group, fake_ans_record in zip(passages_group, fake_ans_record_group):#形成多个sample
+                data_set.append({'pool_idx': len(self.train_pools) - 1,
+                                 'passage_idxs': p_group,
+                                 'fake_ans_record': fake_ans_record})
+        return data_set
+
+    def _join_multi_span_records(self, data_globalPara_path, data_globalMultiSpan_path):
+        """
+        Joins the paragraph file and the multi-span file on question_id in a single pass.
+        Both files are expected in the same order (as written by preprocessing, or both sorted by
+        question_id), then the multi-span records are merge-joined and only one of them is held
+        at a time. On the first record that does not match, the rest of the join falls back to
+        a byte-offset index of the multi-span file.
+        Returns:
+            a generator of (sample, multiSpanRecord)
+        """
+        offset_index = None
+        with open_file(data_globalPara_path) as fin_para, open_file(data_globalMultiSpan_path, 'rb') as fin_multiSpan:
+            line = fin_multiSpan.readline()
+            multiSpanRecord = json.loads(line.strip()) if line else None
             for lidx, line in enumerate(fin_para):
                 sample = json.loads(line.strip())
-                multiSpanRecord=multiSpanRecords[sample['question_id']]
-                idx_toremove=[]
-                for idx, spanScore in enumerate(multiSpanRecord['multi_spanScore_f1']):
-                    if spanScore[2][1]>= self.max_p_len or spanScore[-1]<threshold:
-                        idx_toremove.append(idx)
-                multiSpanRecord['multi_spanScore_f1']=[item for i,item in enumerate(multiSpanRecord['multi_spanScore_f1']) if i not in idx_toremove]
-                
-                ans_para_num=len(multiSpanRecord['multi_spanScore_f1'])#会形成的样本个数~
+                question_id = sample['question_id']
+                if offset_index is None:
+                    # skip the multi-span records of the questions absent from the paragraph file
+                    while multiSpanRecord is not None and multiSpanRecord['question_id'] < question_id:
+                        line = fin_multiSpan.readline()
+                        multiSpanRecord = json.loads(line.strip()) if line else None
+                    if multiSpanRecord is not None and multiSpanRecord['question_id'] == question_id:
+                        yield sample, multiSpanRecord
+                        line = fin_multiSpan.readline()
+                        multiSpanRecord = json.loads(line.strip()) if line else None
+                        continue
+                    self.logger.warning('{} and {} are not in the same question_id order, '
+                                        'joining them with a byte-offset index.'.format(
+                                            data_globalPara_path, data_globalMultiSpan_path))
+                    offset_index = self._index_question_offsets(fin_multiSpan)
+                fin_multiSpan.seek(offset_index[question_id])
+                yield sample, json.loads(fin_multiSpan.readline().strip())
 
-                if ans_para_num==0:
-                    continue
-                
-                passages_group=[]
-                # for_debug=[]
-                fake_ans_record_group=[]
-                for i in range(ans_para_num):
-                    passages_group.append([])
-                    # for_debug.append([])
-                    fake_ans_record_group.append(())
-                group_idx_pos=0#标示 找到的fake_span所在passage送入的group
-                group_idx_neg=0#标示 找到的负例送入的group
-                
-                paragScoreRecords=[]
-                for k,v in sample['paragScore_recall_a'].items():
-                    for item in v:
-                        paragScoreRecords.append((k,item[0],item[1]))
-                
-                sortedParagResult=sorted(paragScoreRecords, key=lambda record: record[-1],reverse=True)
-                # print('len(sortedParagResult)',len(sortedParagResult))
-                pos_num=0
-                for r_idx, paragScoreRecord in enumerate(sortedParagResult):
-                    is_pos=False#每篇passage初始化为不是正例
-                    #首先判断是否是正例，若是，则放入指定的group，并不再作为负例
-                    for psg_idx, spanScore in enumerate(multiSpanRecord['multi_spanScore_f1']):
-                        if int(paragScoreRecord[0])==spanScore[0] and paragScoreRecord[1]==spanScore[1] and group_idx_pos<ans_para_num:
-                            is_pos=True
-                            if group_idx_pos<ans_para_num:#每组只会增加一个额外正例
-                                passages_group[group_idx_pos].append(
-                                            {'passage_tokens': sample['documents'][int(paragScoreRecord[0])]['segmented_paragraphs'][paragScoreRecord[1]],
-                                             'is_selected': sample['documents'][int(paragScoreRecord[0])]['is_selected']}
-                                        )
-                                fake_ans_record_group[group_idx_pos]=(len(passages_group[group_idx_pos])-1, spanScore[2])
-                                # for_debug[group_idx_pos].append((r_idx,paragScoreRecord[0],paragScoreRecord[1]))
-                                group_idx_pos+=1
-                    if is_pos:
-                        pos_num+=1
-                    #作为负例加入相应的group-(1)首先是否属于top3 负例
-                    if is_pos==False:
-                        if r_idx+1 - pos_num<3:#说明该篇章属于top3负例（当前总passage数-属于正例passage数）
-                            for group_idx in range(ans_para_num):
-                                passages_group[group_idx].append(
-                                            {'passage_tokens': sample['documents'][int(paragScoreRecord[0])]['segmented_paragraphs'][paragScoreRecord[1]],
-                                             'is_selected': sample['documents'][int(paragScoreRecord[0])]['is_selected']}
-                                        )
-                                # for_debug[group_idx].append((r_idx,paragScoreRecord[0],paragScoreRecord[1]))
-                        else:
-                            if group_idx_neg<ans_para_num:#每组只会增加一个额外负例
-                                passages_group[group_idx_neg].append(
-                                            {'passage_tokens': sample['documents'][int(paragScoreRecord[0])]['segmented_paragraphs'][paragScoreRecord[1]],
-                                             'is_selected': sample['documents'][int(paragScoreRecord[0])]['is_selected']}
-                                        )
-                                # for_debug[group_idx_neg].append((r_idx,paragScoreRecord[0],paragScoreRecord[1]))
-                                group_idx_neg+=1
-                    if group_idx_pos==ans_para_num and group_idx_neg==ans_para_num:#每组已经找够了
-                        break
+    def _index_question_offsets(self, fin):
+        """
+        Maps the question_id of every line of a jsonl file to the byte offset of the line
+        Args:
+            fin: the file opened in binary mode
+        """
+        offset_index = {}
+        fin.seek(0)
+        offset = 0
+        for line in fin:
+            offset_index[json.loads(line.strip())['question_id']] = offset
+            offset += len(line)
+        return offset_index
 
-                # if len(for_debug[0])==6:
-                #     tt=[]
-                #     for record in multiSpanRecord['multi_spanScore_f1']:
-                #         tt.append((record[0],record[1]))
-                #     print('multiSpanRecord[\'multi_spanScore_f1\']',tt)
-                #     print('len(sortedParagResult)',len(sortedParagResult))
-                #     print('fake_ans_record_group',fake_ans_record_group)
-                #     print(for_debug)
-                #     break#TODO--debug
-                sample.pop('documents')
-                for  p_group, fake_ans_record in zip(passages_group, fake_ans_record_group):#形成多个sample
-                    sample['passages']=p_group
-                    sample['fake_ans_record']=fake_ans_record
-                    data_set.append(sample)
-        return data_set
+    def _pool_passage(self, pool, pool_index_of, sample, paragScoreRecord):
+        """
+        Adds the paragraph of a score record to the passage pool of its sample, once
+        Returns:
+            the index of the passage in the pool
+        """
+        para_key = (paragScoreRecord[0], paragScoreRecord[1])
+        if para_key not in pool_index_of:
+            doc = sample['documents'][paragScoreRecord[0]]
+            pool_index_of[para_key] = len(pool['passages'])
+            pool['passages'].append({'passage_tokens': doc['segmented_paragraphs'][paragScoreRecord[1]],
+                                     'is_selected': doc['is_selected']})
+        return pool_index_of[para_key]
+
+    def _get_question_and_passages(self, sample):
+        """
+        Resolves a train group view against its passage pool, other samples hold their own passages
+        Returns:
+            the question token ids and the passages of the sample
+        """
+        if 'pool_idx' in sample:
+            pool = self.train_pools[sample['pool_idx']]
+            return pool['question_token_ids'], [pool['passages'][pidx] for pidx in sample['passage_idxs']]
+        return sample['question_token_ids'], sample['passages']
 
     def _load_dataset(self, data_path, train=False):
         """
@@ -162,7 +213,7 @@ class BRCDataset(object):
         Args:
             data_path: the data file to load
         """
-        with open(data_path) as fin:
+        with open_file(data_path) as fin:
             data_set = []
             for lidx, line in enumerate(fin):
                 sample = json.loads(line.strip())
@@ -220,11 +271,12 @@ class BRCDataset(object):
                       'end_id': []}
         max_passage_num = self.max_p_num
         for sidx, sample in enumerate(batch_data['raw_data']):
+            question_token_ids, passages = self._get_question_and_passages(sample)
             for pidx in range(max_passage_num):
-                if pidx < len(sample['passages']):
-                    batch_data['question_token_ids'].append(sample['question_token_ids'])
-                    batch_data['question_length'].append(len(sample['question_token_ids']))
-                    passage_token_ids = sample['passages'][pidx]['passage_token_ids']
+                if pidx < len(passages):
+                    batch_data['question_token_ids'].append(question_token_ids)
+                    batch_data['question_length'].append(len(question_token_ids))
+                    passage_token_ids = passages[pidx]['passage_token_ids']
                     batch_data['passage_token_ids'].append(passage_token_ids)
                     batch_data['passage_length'].append(min(len(passage_token_ids), self.max_p_len))
                 else:
@@ -271,9 +323,9 @@ class BRCDataset(object):
             a generator
         """
         if set_name is None:
-            data_set = self.train_set + self.dev_set + self.test_set
+            data_set = self.train_pools + self.dev_set + self.test_set
         elif set_name == 'train':
-            data_set = self.train_set
+            data_set = self.train_pools
         elif set_name == 'dev':
             data_set = self.dev_set
         elif set_name == 'test':
@@ -294,7 +346,7 @@ class BRCDataset(object):
         Args:
             vocab: the vocabulary on this dataset
         """
-        for data_set in [self.train_set, self.dev_set, self.test_set]:
+        for data_set in [self.train_pools, self.dev_set, self.test_set]:
             if data_set is None:
                 continue
             for sample in data_set:
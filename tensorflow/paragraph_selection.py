@@ -0,0 +1,161 @@
+# -*- coding:utf8 -*-
+"""
+This module implements the global paragraph selection shared by all BRCDataset variants.
+The paragraph scores of a sample (paragScore_recall_a / paragScore_recall_q) are dicts
+mapping a doc index string to a list of [para_idx, score] records.
+The paragraphs are ranked by score, ties go to the earlier document, then the earlier paragraph.
+The paragraphs picked offline for the search dev/test sets (top5_para_ids files written by
+lr_predict_forTOP5) are joined to the samples by question_id.
+
+Run this module directly for a microbenchmark against the full sort.
+"""
+
+import heapq
+import json
+import os
+import random
+import sys
+import time
+# the root utils dir, the model variants have their own utils package without file_utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from file_utils import open_file
+
+
+def iter_paragraph_scores(score_dict):
+    """
+    Iterates over the records of a paragraph score dict without materializing them
+    Args:
+        score_dict: a dict mapping a doc index string to [para_idx, score] records
+    Returns:
+        a generator of (doc_idx, para_idx, score), the doc index is converted to int once
+    """
+    for doc_key, records in score_dict.items():
+        doc_idx = int(doc_key)
+        for record in records:
+            yield doc_idx, record[0], record[1]
+
+
+def select_top_paragraphs(score_dict, top_k):
+    """
+    Selects the top_k paragraphs with a bounded min-heap of size top_k, whose root is the
+    worst paragraph kept so far, so most records are rejected by a single comparison
+    Args:
+        score_dict: a dict mapping a doc index string to [para_idx, score] records
+        top_k: number of paragraphs to select
+    Returns:
+        a list of (doc_idx, para_idx, score), best first
+    """
+    heap = []
+    for doc_key, records in score_dict.items():
+        neg_doc_idx = -int(doc_key)
+        for record in records:
+            score = record[1]
+            if len(heap) < top_k:
+                heapq.heappush(heap, (score, neg_doc_idx, -record[0]))
+            elif score >= heap[0][0]:
+                # a larger item is a better paragraph, i.e. an earlier one on ties
+                item = (score, neg_doc_idx, -record[0])
+                if item > heap[0]:
+                    heapq.heapreplace(heap, item)
+    heap.sort(reverse=True)
+    return [(-neg_doc_idx, -neg_para_idx, score) for score, neg_doc_idx, neg_para_idx in heap]
+
+
+def iter_ranked_paragraphs(score_dict):
+    """
+    Lazily iterates over all the paragraphs best first, for callers that do not know
+    in advance how many paragraphs they will consume
+    Args:
+        score_dict: a dict mapping a doc index string to [para_idx, score] records
+    Returns:
+        a generator of (doc_idx, para_idx, score)
+    """
+    heap = [(-score, doc_idx, para_idx) for doc_idx, para_idx, score in iter_paragraph_scores(score_dict)]
+    heapq.heapify(heap)
+    while heap:
+        neg_score, doc_idx, para_idx = heapq.heappop(heap)
+        yield doc_idx, para_idx, -neg_score
+
+
+def load_top_paragraph_ids(top_pid_path):
+    """
+    Indexes a top paragraph id file by question_id, so that it does not have to be read
+    in lockstep with the data file
+    Args:
+        top_pid_path: a file of {'question_id', 'top5_para_ids'} lines, plain or compressed
+    Returns:
+        a dict mapping a question_id to its list of [doc_idx, para_idx]
+    """
+    top_pids = {}
+    with open_file(top_pid_path) as fin:
+        for line in fin:
+            record = json.loads(line)
+            top_pids[record['question_id']] = record['top5_para_ids']
+    return top_pids
+
+
+def gather_paragraphs(documents, para_ids):
+    """
+    Pulls the selected paragraphs out of the documents by direct indexing
+    Args:
+        documents: the documents of a sample
+        para_ids: a list of [doc_idx, para_idx]
+    Returns:
+        a list of paragraph tokens, in document order
+    """
+    return [documents[doc_idx]['segmented_paragraphs'][para_idx]
+            for doc_idx, para_idx in sorted(tuple(para_id) for para_id in para_ids)]
+
+
+def _sort_all(score_dict, top_k):
+    """
+    The previous selection, flattens and fully sorts all the records
+    """
+    records = []
+    for k, v in score_dict.items():
+        for item in v:
+            records.append((k, item[0], item[1]))
+    return sorted(records, key=lambda record: record[-1], reverse=True)[:top_k]
+
+
+def _random_score_dict(rng):
+    """
+    A sample shaped like DuReader: up to 5 documents, the paragraph number of a document
+    has a long tail (search pages), and the scores are rounded so that ties happen
+    """
+    score_dict = {}
+    for doc_idx in range(rng.randint(1, 5)):
+        para_num = min(int(rng.paretovariate(1.2) * 3), 300)
+        score_dict[str(doc_idx)] = [[para_idx, round(rng.random(), 2)] for para_idx in range(para_num)]
+    return score_dict
+
+
+def benchmark(sample_num=20000, top_k=5, seed=0):
+    """
+    Compares the heap selection with the full sort on random samples,
+    grouped by the number of paragraph records of a sample
+    """
+    rng = random.Random(seed)
+    groups = {}
+    for _ in range(sample_num):
+        sample = _random_score_dict(rng)
+        record_num = sum(len(v) for v in sample.values())
+        group = '<=50' if record_num <= 50 else ('<=200' if record_num <= 200 else '>200')
+        groups.setdefault(group, []).append(sample)
+    for group in ['<=50', '<=200', '>200']:
+        samples = groups.get(group, [])
+        if not samples:
+            continue
+        for name, select_fn in [('sort', _sort_all), ('heap', select_top_paragraphs)]:
+            start_t = time.time()
+            for sample in samples:
+                select_fn(sample, top_k)
+            print('top {}, {} records: {} {:.3f}s for {} samples'.format(
+                top_k, group, name, time.time() - start_t, len(samples)))
+        for sample in samples:
+            assert [r[-1] for r in _sort_all(sample, top_k)] == [r[-1] for r in select_top_paragraphs(sample, top_k)]
+
+
+if __name__ == '__main__':
+    benchmark(top_k=5)
+    benchmark(top_k=9)
@@ -25,23 +25,37 @@ import os
 import time
 import logging
 import json
+import glob
+import hashlib
 import numpy as np
 import tensorflow as tf
 import keras.backend as K
+from tensorflow.python.ops import gen_checkpoint_ops
 from utils import compute_bleu_rouge
 from utils import normalize
-from layers.basic_rnn import rnn, cudnn_rnn, bilstm, bilstm_layer
+from utils import open_file
+from layers.basic_rnn import rnn, cudnn_rnn, bilstm, bilstm_layer, segment_bilstm_layer
 from layers.match_layer import MatchLSTMLayer
-from layers.match_layer import AttentionFlowMatchLayer
+from layers.match_layer import AttentionFlowMatchLayer, padding_mask, segment_mask
 from layers.pointer_net import PointerNetDecoder
 
+# the tensors and ops used after the graph is built, each kept in a collection of its name,
+# so that they are found again in a cached meta graph
+GRAPH_HANDLES = ['p', 'q', 'p_length', 'q_length', 'start_label', 'end_label', 'dropout_keep_prob',
+                 'segment_ids', 'start_probs', 'end_probs', 'loss', 'train_op']
+# bumped when the cached graphs must be built again for a reason the sources do not show
+GRAPH_FORMAT_VERSION = 1
+# the sources the graph is built from, a cached graph is only imported into the code that built it
+GRAPH_SOURCES = [os.path.abspath(__file__)] + sorted(glob.glob(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'layers', '*.py')))
+
 
 class RCModel(object):
     """
     Implements the main reading comprehension model.
     """
 
-    def __init__(self, vocab, args):
+    def __init__(self, vocab, args, start_t=None):
 
         # logging
         self.logger = logging.getLogger("brc")
@@ -59,10 +73,20 @@ class RCModel(object):
         self.max_p_len = args.max_p_len
         self.max_q_len = args.max_q_len
         self.max_a_len = args.max_a_len
+        # if > 0, the passages of a sample are packed into rows (see BRCDataset._packed_mini_batch)
+        self.pack_len = args.pack_len
 
         # the vocab
         self.vocab = vocab
 
+        # number of batches trained so far
+        self.global_step = 0
+
+        # the meta graphs are cached in this dir by configuration, empty to always build the graph
+        self.graph_cache_dir = args.graph_cache_dir
+        # the start time of the process, the time to the first batch is logged if set
+        self.start_t = start_t
+
         # session info
         sess_config = tf.ConfigProto()
         sess_config.gpu_options.allow_growth = True
@@ -76,12 +100,30 @@ class RCModel(object):
 
         # initialize the model
         self.sess.run(tf.global_variables_initializer())
+        if self.vocab.embeddings is not None:
+            # fed once instead of being a constant of the graph
+            self.word_embeddings.load(self.vocab.embeddings, self.sess)
+        self.logger.info('There are {} parameters in the model'.format(self._param_num()))
+        if self.start_t is not None:
+            self.logger.info('Model ready {:.1f}s after the start.'.format(time.time() - self.start_t))
 
     def _build_graph(self):
         """
-        Builds the computation graph with Tensorflow
+        Builds the computation graph with Tensorflow, or imports it from the graph cache
         """
         start_t = time.time()
+        meta_path = self._graph_cache_path()
+        if meta_path and os.path.exists(meta_path):
+            tf.train.import_meta_graph(meta_path)
+            for name in GRAPH_HANDLES:
+                handles = tf.get_collection(name)
+                setattr(self, name, handles[0] if handles else None)
+            self.all_params = tf.trainable_variables()
+            # a variable in a collection of our own comes back as its tensor, it is found by name
+            self.word_embeddings = [var for var in tf.global_variables()
+                                    if var.op.name == 'word_embedding/word_embeddings'][0]
+            self.logger.info('Time to import graph from {}: {} s'.format(meta_path, time.time() - start_t))
+            return
         self._setup_placeholders()
         self._embed()
         self._encode()
@@ -90,9 +132,64 @@ class RCModel(object):
         self._decode()
         self._compute_loss()
         self._create_train_op()
+        for name in GRAPH_HANDLES:
+            if getattr(self, name) is not None:
+                tf.add_to_collection(name, getattr(self, name))
         self.logger.info('Time to build graph: {} s'.format(time.time() - start_t))
-        param_num = sum([np.prod(self.sess.run(tf.shape(v))) for v in self.all_params])
-        self.logger.info('There are {} parameters in the model'.format(param_num))
+        if meta_path:
+            if not os.path.exists(self.graph_cache_dir):
+                os.makedirs(self.graph_cache_dir)
+            # renamed last, concurrent jobs never import a half written graph
+            tf.train.export_meta_graph(filename=meta_path + '.tmp')
+            os.rename(meta_path + '.tmp', meta_path)
+            self.logger.info('Graph cached in {}'.format(meta_path))
+
+    def _graph_cache_path(self):
+        """
+        The cached meta graph of the configuration of the model, None if the cache is disabled
+        """
+        if not self.graph_cache_dir:
+            return None
+        config = {'algo': self.algo, 'hidden_size': self.hidden_size, 'optim_type': self.optim_type,
+                  'learning_rate': self.learning_rate, 'weight_decay': self.weight_decay,
+                  'use_dropout': self.use_dropout, 'pack_len': self.pack_len,
+                  'vocab_size': self.vocab.size(), 'embed_dim': self.vocab.embed_dim,
+                  'tf_version': tf.__version__, 'format_version': GRAPH_FORMAT_VERSION,
+                  'sources': self._sources_hash()}
+        config_key = hashlib.md5(json.dumps(config, sort_keys=True).encode('utf8')).hexdigest()
+        return os.path.join(self.graph_cache_dir, 'graph_{}.meta'.format(config_key))
+
+    @staticmethod
+    def _sources_hash():
+        """
+        The md5 of the model and layer sources, see GRAPH_SOURCES
+        """
+        md5 = hashlib.md5()
+        for source in GRAPH_SOURCES:
+            with open(source, 'rb') as fin:
+                md5.update(fin.read())
+        return md5.hexdigest()
+
+    def _param_num(self):
+        """
+        Counts the parameters from the static shapes, only the variables whose shape
+        is unknown until run time are asked to the session
+        """
+        param_num = 0
+        for var in self.all_params:
+            var_num = var.get_shape().num_elements()
+            if var_num is None:
+                var_num = self.sess.run(tf.size(var))
+            param_num += int(var_num)
+        return param_num
+
+    def _report_first_batch(self):
+        """
+        Logs the time from the start of the process to the end of the first batch, once
+        """
+        if self.start_t is not None:
+            self.logger.info('First batch done {:.1f}s after the start.'.format(time.time() - self.start_t))
+            self.start_t = None
 
     def _setup_placeholders(self):
         """
@@ -105,6 +202,15 @@ class RCModel(object):
         self.start_label = tf.placeholder(tf.int32, [None])
         self.end_label = tf.placeholder(tf.int32, [None])
         self.dropout_keep_prob = tf.placeholder(tf.float32)
+        self.segment_ids = tf.placeholder(tf.int32, [None, None]) if self.pack_len > 0 else None
+
+    def _passage_bilstm(self, inputs):
+        """
+        The Bi-LSTM over the passage rows, the packed passages are run through the same layer one row each
+        """
+        if self.segment_ids is not None:
+            return segment_bilstm_layer(inputs, self.segment_ids, self.hidden_size)
+        return bilstm_layer(inputs, self.p_length, self.hidden_size, layer_num=1)
 
     def _embed(self):
         """
@@ -114,7 +220,7 @@ class RCModel(object):
             self.word_embeddings = tf.get_variable(
                 'word_embeddings',
                 shape=(self.vocab.size(), self.vocab.embed_dim),
-                initializer=tf.constant_initializer(self.vocab.embeddings),
+                initializer=tf.zeros_initializer(),
                 trainable=True
             )
             self.p_emb = tf.nn.embedding_lookup(self.word_embeddings, self.p)
@@ -129,7 +235,7 @@ class RCModel(object):
             self.q_emb = tf.nn.dropout(self.q_emb, self.dropout_keep_prob)
 
         with tf.variable_scope('passage_encoding'):
-            self.sep_p_encodes, _ = bilstm_layer(self.p_emb, self.p_length, self.hidden_size)
+            self.sep_p_encodes, _ = self._passage_bilstm(self.p_emb)
         with tf.variable_scope('question_encoding'):
             self.sep_q_encodes, _ = bilstm_layer(self.q_emb, self.q_length, self.hidden_size)
 
@@ -145,7 +251,8 @@ class RCModel(object):
             match_layer = AttentionFlowMatchLayer(self.hidden_size)
         else:
             raise NotImplementedError('The algorithm {} is not implemented.'.format(self.algo))
-        self.match_p_encodes, _ = match_layer.match(self.sep_p_encodes, self.sep_q_encodes, self.hidden_size)
+        self.match_p_encodes, _ = match_layer.match(self.sep_p_encodes, self.sep_q_encodes,
+                                                    self.p_length, self.q_length, self.segment_ids)
 
     def _fuse(self):
         """
@@ -159,8 +266,7 @@ class RCModel(object):
             if self.use_dropout:
                 self.residual_p_emb = tf.nn.dropout(self.match_p_encodes, self.dropout_keep_prob)
 
-            self.residual_p_encodes, _ = bilstm_layer(self.residual_p_emb, self.p_length,
-                                             self.hidden_size, layer_num=1)
+            self.residual_p_encodes, _ = self._passage_bilstm(self.residual_p_emb)
             if self.use_dropout:
                 self.residual_p_encodes = tf.nn.dropout(self.residual_p_encodes, self.dropout_keep_prob)
             #bilstm不能直接连接dense AttributeError: 'Bidirectional' object has no attribute 'outbound_nodes'
@@ -177,6 +283,11 @@ class RCModel(object):
             batch_size, num_rows = tf.shape(sim_matrix)[0:1], tf.shape(sim_matrix)[1]
             mask = tf.eye(num_rows, batch_shape=batch_size)
             sim_matrix = sim_matrix + -1e9 * mask
+            if self.segment_ids is not None:
+                # the packed passages do not attend to each other
+                sim_matrix = sim_matrix + -1e9 * (1.0 - segment_mask(self.segment_ids))
+            else:
+                sim_matrix = sim_matrix + tf.expand_dims(padding_mask(self.p_length, num_rows), 1)
 
             context2question_attn = tf.matmul(tf.nn.softmax(sim_matrix, -1), self.residual_p_encodes)
             concat_outputs = tf.concat([self.residual_p_encodes, context2question_attn,
@@ -195,19 +306,24 @@ class RCModel(object):
         And since the encodes of queries in the same document is same, we select the first one.
         """
         with tf.variable_scope('start_pos_predict'):
-            self.fuse_p_encodes, _ = bilstm_layer(self.match_p_encodes, self.p_length,
-                                         self.hidden_size, layer_num=1)
+            self.fuse_p_encodes, _ = self._passage_bilstm(self.match_p_encodes)
             start_weight = tf.get_variable("start_weight", self.hidden_size * 2)
             start_logits = tf.tensordot(self.fuse_p_encodes, start_weight, axes=[[2], [0]])
 
         with tf.variable_scope('end_pos_predict'):
             concat_GM_2 = tf.concat([self.match_p_encodes, self.fuse_p_encodes], -1)
-            self.end_p_encodes, _ = bilstm_layer(concat_GM_2, self.p_length,
-                                        self.hidden_size, layer_num=1)
+            self.end_p_encodes, _ = self._passage_bilstm(concat_GM_2)
             
             end_weight = tf.get_variable("start_weight", self.hidden_size * 2)
             end_logits = tf.tensordot(self.end_p_encodes, end_weight, axes=[[2], [0]])
 
+        # the padding is not a candidate position, in the packed rows as in the passage rows
+        if self.segment_ids is not None:
+            padding = -1e9 * tf.cast(tf.equal(self.segment_ids, 0), tf.float32)
+        else:
+            padding = padding_mask(self.p_length, tf.shape(start_logits)[1])
+        start_logits, end_logits = start_logits + padding, end_logits + padding
+
         with tf.variable_scope('same_question_concat'):
             batch_size = tf.shape(self.start_label)[0]
 
@@ -258,16 +374,18 @@ class RCModel(object):
             raise NotImplementedError('Unsupported optimizer: {}'.format(self.optim_type))
         self.train_op = self.optimizer.minimize(self.loss)
 
-    def _train_epoch(self, train_batches, dropout_keep_prob):
+    def _train_epoch(self, train_batches, dropout_keep_prob, start_batch=0, step_fn=None):
         """
         Trains the model for a single epoch.
         Args:
             train_batches: iterable batch data for training
             dropout_keep_prob: float value indicating dropout keep probability
+            start_batch: number of batches of this epoch already trained before a restart
+            step_fn: called with the batch cursor of this epoch after every batch
         """
         total_num, total_loss = 0, 0
         log_every_n_batch, n_batch_loss = 50, 0
-        for bitx, batch in enumerate(train_batches, 1):
+        for bitx, batch in enumerate(train_batches, start_batch + 1):
             feed_dict = {self.p: batch['passage_token_ids'],
                          self.q: batch['question_token_ids'],
                          self.p_length: batch['passage_length'],
@@ -275,8 +393,10 @@ class RCModel(object):
                          self.start_label: batch['start_id'],
                          self.end_label: batch['end_id'],
                          self.dropout_keep_prob: dropout_keep_prob}
-            _, loss = self.sess.run([tf.shape(self.sep_p_encodes), tf.shape(self.sep_q_encodes)], feed_dict)
+            if self.segment_ids is not None:
+                feed_dict[self.segment_ids] = batch['segment_ids']
             _, loss = self.sess.run([self.train_op, self.loss], feed_dict)
+            self._report_first_batch()
             total_loss += loss * len(batch['raw_data'])
             total_num += len(batch['raw_data'])
             n_batch_loss += loss
@@ -284,10 +404,14 @@ class RCModel(object):
                 self.logger.info('Average loss from batch {} to {} is {}'.format(
                     bitx - log_every_n_batch + 1, bitx, n_batch_loss / log_every_n_batch))
                 n_batch_loss = 0
-        return 1.0 * total_loss / total_num
+            self.global_step += 1
+            if step_fn is not None:
+                step_fn(bitx)
+        return 1.0 * total_loss / max(total_num, 1)
 
     def train(self, data, epochs, batch_size, save_dir, save_prefix,
-              dropout_keep_prob=1.0, evaluate=True):
+              dropout_keep_prob=1.0, evaluate=True, eval_every_n_steps=0, eval_subset_size=1000,
+              save_every_n_steps=0, train_state=None):
         """
         Train the model with data
         Args:
@@ -298,19 +422,58 @@ class RCModel(object):
             save_prefix: the prefix indicating the model type
             dropout_keep_prob: float value indicating dropout keep probability
             evaluate: whether to evaluate the model on test set after each epoch
+            eval_every_n_steps: if > 0, evaluate on a stratified dev subset every n steps
+            eval_subset_size: number of dev questions in the subset
+            save_every_n_steps: if > 0, save a resumable checkpoint every n steps
+            train_state: the state returned by restore_train_state, training resumes
+                         from the first unseen batch if it is given
         """
         pad_id = self.vocab.get_id(self.vocab.pad_token)
-        max_bleu_4 = 0
-        for epoch in range(1, epochs + 1):
-            self.logger.info('Training the model for epoch {}'.format(epoch))
-            train_batches = data.gen_mini_batches('train', batch_size, pad_id, shuffle=True)
-            train_loss = self._train_epoch(train_batches, dropout_keep_prob)
+        start_t = time.time()
+        if train_state is None:
+            train_state = {'epoch': 1, 'batch_cursor': 0, 'max_bleu_4': 0,
+                           'shuffle_seed': np.random.randint(2 ** 31 - epochs - 1)}
+        elif train_state.get('train_size', len(data.train_set)) != len(data.train_set):
+            self.logger.warning('Train set size changed since the checkpoint, '
+                                'the remaining batches of the epoch will differ.')
+        max_bleu_4 = train_state['max_bleu_4']
+        shuffle_seed = train_state['shuffle_seed']
+
+        subset_ref_dict = None
+        if eval_every_n_steps > 0 and len(data.dev_set) > 0:
+            data.sample_dev_subset(eval_subset_size)
+            # the subset is fixed, so its references are normalized only once
+            subset_ref_dict = self._normalized_references(data.load_raw_samples(data.dev_subset))
+
+        def step_fn(batch_cursor):
+            if subset_ref_dict is not None and self.global_step % eval_every_n_steps == 0:
+                eval_batches = data.gen_mini_batches('dev_subset', batch_size, pad_id, shuffle=False,
+                                                     sort_by_length=True)
+                eval_loss, bleu_rouge = self.evaluate(eval_batches, ref_dict=subset_ref_dict)
+                self.logger.info('Dev subset at step {} ({:.0f}s elapsed): loss {}, Rouge-L {}, Bleu-4 {}'.format(
+                    self.global_step, time.time() - start_t, eval_loss,
+                    bleu_rouge['Rouge-L'], bleu_rouge['Bleu-4']))
+            if save_every_n_steps > 0 and self.global_step % save_every_n_steps == 0:
+                self.save_train_state(save_dir, save_prefix, {
+                    'epoch': epoch, 'batch_cursor': batch_cursor, 'max_bleu_4': max_bleu_4,
+                    'shuffle_seed': shuffle_seed, 'train_size': len(data.train_set)})
+
+        for epoch in range(train_state['epoch'], epochs + 1):
+            start_batch = train_state['batch_cursor'] if epoch == train_state['epoch'] else 0
+            if start_batch > 0:
+                self.logger.info('Resuming epoch {} from batch {}'.format(epoch, start_batch + 1))
+            else:
+                self.logger.info('Training the model for epoch {}'.format(epoch))
+            # the permutation of each epoch is reproducible from the seed, so that it can be resumed
+            train_batches = data.gen_mini_batches('train', batch_size, pad_id, shuffle=True,
+                                                  seed=shuffle_seed + epoch, start_batch=start_batch)
+            train_loss = self._train_epoch(train_batches, dropout_keep_prob, start_batch, step_fn)
             self.logger.info('Average train loss for epoch {} is {}'.format(epoch, train_loss))
 
             if evaluate:
                 self.logger.info('Evaluating the model after epoch {}'.format(epoch))
                 if data.dev_set is not None:
-                    eval_batches = data.gen_mini_batches('dev', batch_size, pad_id, shuffle=False)
+                    eval_batches = data.gen_mini_batches('dev', batch_size, pad_id, shuffle=False, sort_by_length=True)
                     eval_loss, bleu_rouge = self.evaluate(eval_batches)
                     self.logger.info('Dev eval loss {}'.format(eval_loss))
                     self.logger.info('Dev eval result: {}'.format(bleu_rouge))
@@ -322,8 +485,13 @@ class RCModel(object):
                     self.logger.warning('No dev set is loaded for evaluation in the dataset!')
             else:
                 self.save(save_dir, save_prefix + '_' + str(epoch))
+            if save_every_n_steps > 0:
+                self.save_train_state(save_dir, save_prefix, {
+                    'epoch': epoch + 1, 'batch_cursor': 0, 'max_bleu_4': max_bleu_4,
+                    'shuffle_seed': shuffle_seed, 'train_size': len(data.train_set)})
 
-    def evaluate(self, eval_batches, result_dir=None, result_prefix=None, save_full_info=False):
+    def evaluate(self, eval_batches, result_dir=None, result_prefix=None, save_full_info=False,
+                 ref_dict=None, result_ext='.json'):
         """
         Evaluates the model performance on eval_batches and results are saved if specified
         Args:
@@ -332,8 +500,12 @@ class RCModel(object):
             result_prefix: prefix of the file for saving predicted answers,
                            answers will not be saved if None
             save_full_info: if True, the pred_answers will be added to raw sample and saved
+            ref_dict: normalized reference answers computed in advance,
+                      see _normalized_references
+            result_ext: extension of the result file, .json.gz/.json.bz2/.json.xz to compress it
         """
         pred_answers, ref_answers = [], []
+        pred_orders, ref_orders = [], []
         total_loss, total_num = 0, 0
         for b_itx, batch in enumerate(eval_batches):
             feed_dict = {self.p: batch['passage_token_ids'],
@@ -343,19 +515,33 @@ class RCModel(object):
                          self.start_label: batch['start_id'],
                          self.end_label: batch['end_id'],
                          self.dropout_keep_prob: 1.0}
+            if self.segment_ids is not None:
+                feed_dict[self.segment_ids] = batch['segment_ids']
             # print(self.sess.run([tf.shape(self.match_p_encodes)], feed_dict))
             start_probs, end_probs, loss = self.sess.run([self.start_probs,
                                                           self.end_probs, self.loss], feed_dict)
+            self._report_first_batch()
 
             total_loss += loss * len(batch['raw_data'])
             total_num += len(batch['raw_data'])
 
             padded_p_len = len(batch['passage_token_ids'][0])
-            for sample, start_prob, end_prob in zip(batch['raw_data'], start_probs, end_probs):
-
-                best_answer,segmented_answer = self.find_best_answer(sample, start_prob, end_prob, padded_p_len)
+            raw_data = batch['raw_data']
+            if 'load_raw_data' in batch:
+                # the text fields of compact samples are only parsed now, to decode the answers
+                raw_data = batch['load_raw_data'](raw_data)
+            passage_starts = batch.get('passage_starts', [None] * len(raw_data))
+            # the positions of the samples in the data set, the batches may be sorted by length
+            orders = batch.get('indices', range(total_num - len(raw_data), total_num))
+            for sample, start_prob, end_prob, starts, order in zip(raw_data, start_probs, end_probs,
+                                                                   passage_starts, orders):
+                pred_orders.append(order)
+
+                best_answer,segmented_answer,answer_source = self.find_best_answer(sample, start_prob, end_prob,
+                                                                                   padded_p_len, starts)
                 if save_full_info:
                     sample['pred_answers'] = [best_answer]
+                    sample['pred_answer_source'] = answer_source
                     pred_answers.append(sample)
                 else:
                     if sample['question_type']=='YES_NO':
@@ -364,24 +550,30 @@ class RCModel(object):
                                              'segmented_question': sample['segmented_question'],
                                              'answers': [best_answer],
                                              'segmented_answers': segmented_answer,#TODO
+                                             'answer_source': answer_source,
                                              'entity_answers': [[]],
                                              'yesno_answers': []})
                     else:
                         pred_answers.append({'question_id': sample['question_id'],
                                              'question_type': sample['question_type'],
                                              'answers': [best_answer],
+                                             'answer_source': answer_source,
                                              'entity_answers': [[]],
                                              'yesno_answers': []})
-                if 'answers' in sample:
+                if ref_dict is None and 'answers' in sample:
+                    ref_orders.append(order)
                     ref_answers.append({'question_id': sample['question_id'],
                                         'question_type': sample['question_type'],
                                         'answers': sample['answers'],
                                         'entity_answers': [[]],
                                         'yesno_answers': []})
 
+        pred_answers = [pred for _, pred in sorted(zip(pred_orders, pred_answers), key=lambda item: item[0])]
+        ref_answers = [ref for _, ref in sorted(zip(ref_orders, ref_answers), key=lambda item: item[0])]
+
         if result_dir is not None and result_prefix is not None:
-            result_file = os.path.join(result_dir, result_prefix + '.json')
-            with open(result_file, 'w') as fout:
+            result_file = os.path.join(result_dir, result_prefix + result_ext)
+            with open_file(result_file, 'w') as fout:
                 for pred_answer in pred_answers:
                     fout.write(json.dumps(pred_answer, ensure_ascii=False) + '\n')
 
@@ -390,7 +582,13 @@ class RCModel(object):
         # this average loss is invalid on test set, since we don't have true start_id and end_id
         ave_loss = 1.0 * total_loss / total_num
         # compute the bleu and rouge scores if reference answers is provided
-        if len(ref_answers) > 0:
+        if ref_dict is not None:
+            pred_dict = {}
+            for pred in pred_answers:
+                if pred['question_id'] in ref_dict:
+                    pred_dict[pred['question_id']] = normalize(pred['answers'])
+            bleu_rouge = compute_bleu_rouge(pred_dict, ref_dict)
+        elif len(ref_answers) > 0:
             pred_dict, ref_dict = {}, {}
             for pred, ref in zip(pred_answers, ref_answers):
                 question_id = ref['question_id']
@@ -402,10 +600,24 @@ class RCModel(object):
             bleu_rouge = None
         return ave_loss, bleu_rouge
 
-    def find_best_answer(self, sample, start_prob, end_prob, padded_p_len):
+    def _normalized_references(self, samples):
+        """
+        Builds the normalized reference answers of samples, keyed by question_id
+        """
+        ref_dict = {}
+        for sample in samples:
+            if len(sample.get('answers', [])) > 0:
+                ref_dict[sample['question_id']] = normalize(sample['answers'])
+        return ref_dict
+
+    def find_best_answer(self, sample, start_prob, end_prob, padded_p_len, passage_starts=None):
         """
         Finds the best answer for a sample given start_prob and end_prob for each position.
-        This will call find_best_answer_for_passage because there are multiple passages in a sample
+        This will call find_best_answer_for_passage because there are multiple passages in a sample,
+        passage_starts gives the position of each passage in a packed batch
+        Returns:
+            the answer, its tokens, and the [doc_idx, para_idx] of the source paragraphs of the passage
+            it was decoded from (several if duplicates were merged into the passage), [] if none
         """
         best_p_idx, best_span, best_score = None, None, 0
 
@@ -413,22 +625,44 @@ class RCModel(object):
             if p_idx >= self.max_p_num:
                 continue
             passage_len = min(self.max_p_len, len(passage['passage_tokens']))
-            answer_span, score = self.find_best_answer_for_passage(
-                start_prob[p_idx * padded_p_len: (p_idx + 1) * padded_p_len],
-                end_prob[p_idx * padded_p_len: (p_idx + 1) * padded_p_len],
-                passage_len)
-            if score > best_score:
-                best_score = score
-                best_p_idx = p_idx
-                best_span = answer_span
+            p_start = p_idx * padded_p_len if passage_starts is None else passage_starts[p_idx]
+            for run_start, run_end in self._contiguous_runs(passage, passage_len):
+                answer_span, score = self.find_best_answer_for_passage(
+                    start_prob[p_start + run_start: p_start + run_end],
+                    end_prob[p_start + run_start: p_start + run_end],
+                    run_end - run_start)
+                if score > best_score:
+                    best_score = score
+                    best_p_idx = p_idx
+                    best_span = (run_start + answer_span[0], run_start + answer_span[1])
         if best_p_idx is None or best_span is None:
             best_answer = ''
             segmented_answer=[]
+            answer_source = []
         else:
-            best_answer = ''.join(
-                sample['passages'][best_p_idx]['passage_tokens'][best_span[0]: best_span[1] + 1])
-            segmented_answer=sample['passages'][best_p_idx]['passage_tokens'][best_span[0]: best_span[1] + 1]
-        return best_answer, segmented_answer
+            best_passage = sample['passages'][best_p_idx]
+            answer_source = best_passage.get('source_paras', [])
+            segmented_answer = best_passage['passage_tokens'][best_span[0]: best_span[1] + 1]
+            best_answer = ''.join(segmented_answer)
+        return best_answer, segmented_answer, answer_source
+
+    @staticmethod
+    def _contiguous_runs(passage, passage_len):
+        """
+        The [start, end) position ranges of a passage that are contiguous in its source paragraph,
+        the whole passage unless it was compressed to windows, so that an answer never skips
+        the source tokens between two windows
+        """
+        token_offsets = passage.get('token_offsets')
+        if token_offsets is None:
+            return [(0, passage_len)]
+        runs, run_start = [], 0
+        for idx in range(1, passage_len):
+            if token_offsets[idx] != token_offsets[idx - 1] + 1:
+                runs.append((run_start, idx))
+                run_start = idx
+        runs.append((run_start, passage_len))
+        return runs
 
     def find_best_answer_for_passage(self, start_probs, end_probs, passage_len=None):
         """
@@ -458,9 +692,99 @@ class RCModel(object):
         self.saver.save(self.sess, os.path.join(model_dir, model_prefix))
         self.logger.info('Model saved in {}, with prefix {}.'.format(model_dir, model_prefix))
 
-    def restore(self, model_dir, model_prefix):
+    def export(self, model_dir, model_prefix, float16=True):
+        """
+        Exports the trained parameters for inference into <model_prefix>_export in model_dir,
+        a .npy file per variable and a manifest, without the optimizer slots. With float16,
+        the word embeddings, which dominate the size, are stored as float16
+        """
+        export_dir = os.path.join(model_dir, model_prefix + '_export')
+        if not os.path.exists(export_dir):
+            os.makedirs(export_dir)
+        manifest = {}
+        for var, value in zip(self.all_params, self.sess.run(self.all_params)):
+            file_name = var.op.name.replace('/', '__') + '.npy'
+            if float16 and var.op.name == self.word_embeddings.op.name:
+                value = value.astype(np.float16)
+            np.save(os.path.join(export_dir, file_name), value)
+            manifest[var.op.name] = file_name
+        # written last, a half written export is never restored
+        with open(os.path.join(export_dir, 'manifest.json'), 'w') as fout:
+            json.dump(manifest, fout)
+        self.logger.info('Model exported to {}.'.format(export_dir))
+
+    def restore_export(self, model_dir, model_prefix, embedding_rows=None):
+        """
+        Restores the parameters exported by export, the float16 ones are upcast
+        Args:
+            embedding_rows: as in restore, only these rows of the word embeddings are read
+        """
+        export_dir = os.path.join(model_dir, model_prefix + '_export')
+        with open(os.path.join(export_dir, 'manifest.json')) as fin:
+            manifest = json.load(fin)
+        for var in self.all_params:
+            value = np.load(os.path.join(export_dir, manifest[var.op.name]), mmap_mode='r')
+            if embedding_rows is not None and var.op.name == self.word_embeddings.op.name:
+                value = value[embedding_rows]
+            # fed through the assign placeholder of the variable, the graph does not grow
+            var.load(np.asarray(value, dtype=var.dtype.base_dtype.as_numpy_dtype), self.sess)
+        self.logger.info('Model restored from {}'.format(export_dir))
+
+    def save_train_state(self, model_dir, model_prefix, train_state):
+        """
+        Saves a resumable checkpoint together with the state of the data iterator:
+        epoch, batch cursor, shuffle seed, best dev metric and the global step
+        """
+        resume_prefix = model_prefix + '_resume'
+        self.saver.save(self.sess, os.path.join(model_dir, resume_prefix))
+        train_state = dict(train_state, global_step=self.global_step)
+        state_file = os.path.join(model_dir, resume_prefix + '.state.json')
+        # write then rename, a preempted job never leaves a half written state behind
+        with open(state_file + '.tmp', 'w') as fout:
+            json.dump(train_state, fout)
+        os.rename(state_file + '.tmp', state_file)
+        self.logger.info('Train state saved in {}: {}'.format(state_file, train_state))
+
+    def restore_train_state(self, model_dir, model_prefix):
+        """
+        Restores the resumable checkpoint saved by save_train_state
+        Returns:
+            the train state, None if no resumable checkpoint is found
+        """
+        resume_prefix = model_prefix + '_resume'
+        state_file = os.path.join(model_dir, resume_prefix + '.state.json')
+        if not os.path.exists(state_file):
+            return None
+        with open(state_file) as fin:
+            train_state = json.load(fin)
+        self.saver.restore(self.sess, os.path.join(model_dir, resume_prefix))
+        self.global_step = train_state['global_step']
+        self.logger.info('Train state restored from {}: {}'.format(state_file, train_state))
+        return train_state
+
+    def restore(self, model_dir, model_prefix, embedding_rows=None):
         """
         Restores the model into model_dir from model_prefix as the model indicator
+        Args:
+            embedding_rows: if the model is built on a compact vocab (see Vocab.restrict_to),
+                            the checkpoint row of each of its tokens, only these rows of the
+                            word embeddings are read from the checkpoint
         """
-        self.saver.restore(self.sess, os.path.join(model_dir, model_prefix))
+        model_path = os.path.join(model_dir, model_prefix)
+        if embedding_rows is None:
+            self.saver.restore(self.sess, model_path)
+        else:
+            # the embeddings and their optimizer slots do not have the shape of the checkpoint
+            other_vars = [var for var in tf.global_variables() if not var.op.name.startswith('word_embedding/')]
+            tf.train.Saver(other_vars).restore(self.sess, model_path)
+            embeddings = gen_checkpoint_ops.load_and_remap_matrix(
+                ckpt_path=model_path,
+                old_tensor_name=self.word_embeddings.op.name,
+                row_remapping=tf.constant(embedding_rows, dtype=tf.int64),
+                col_remapping=tf.constant([], dtype=tf.int64),
+                initializing_values=tf.constant([], dtype=tf.float32),
+                num_rows=len(embedding_rows),
+                num_cols=self.vocab.embed_dim)
+            self.sess.run(self.word_embeddings.assign(embeddings))
+            self.logger.info('Restored {} rows of the word embeddings.'.format(len(embedding_rows)))
         self.logger.info('Model restored from {}, with prefix {}'.format(model_dir, model_prefix))
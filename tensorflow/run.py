@@ -24,12 +24,16 @@ if sys.version[0] == '2':
 sys.path.append('..')
 import os
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
-import pickle
+import time
+# the time to the model and to the first batch is logged from here, before tensorflow is imported
+START_T = time.time()
 import argparse
 import logging
+from functools import partial
 from dataset import BRCDataset
 from vocab import Vocab
 from rc_model import RCModel
+from utils import count_tokens, open_file
 
 #训练集、开发集、测试集全部都用全局选
 #用于最终结果提交
@@ -47,6 +51,8 @@ def parse_args():
                         help='evaluate the model on dev set')
     parser.add_argument('--predict', action='store_true',
                         help='predict the answers for test set with trained model')
+    parser.add_argument('--export', action='store_true',
+                        help='export the trained model for inference, see --from_export')
     parser.add_argument('--gpu', type=str, default='0',
                         help='specify gpu device')
 
@@ -64,13 +70,26 @@ def parse_args():
     train_settings.add_argument('--epochs', type=int, default=10,
                                 help='train epochs')
     train_settings.add_argument('--restore', action='store_true',
-                                help='restore the training')
+                                help='restore the training, resumes from the last unseen batch '
+                                     'if a resumable checkpoint exists')
+    train_settings.add_argument('--save_every_n_steps', type=int, default=0,
+                                help='save a resumable checkpoint every n steps, 0 to disable')
+    train_settings.add_argument('--eval_every_n_steps', type=int, default=0,
+                                help='evaluate on a stratified dev subset every n steps, 0 to disable')
+    train_settings.add_argument('--eval_subset_size', type=int, default=1000,
+                                help='number of dev questions used by the periodic evaluation')
 
     model_settings = parser.add_argument_group('model settings')
     model_settings.add_argument('--algo', choices=['BIDAF'], default='BIDAF',
                                 help='choose the algorithm to use')
     model_settings.add_argument('--embed_size', type=int, default=300,
                                 help='size of the embeddings')
+    model_settings.add_argument('--hash_buckets', type=int, default=0,
+                                help='share this many embeddings among the tokens out of the vocab by hashing, '
+                                     'instead of mapping them to <unk>')
+    model_settings.add_argument('--vocab_top_n', type=int, default=0,
+                                help='keep only the most frequent tokens in the vocab, 0 to keep all, '
+                                     'with --hash_buckets the memory does not grow with the corpus')
     model_settings.add_argument('--hidden_size', type=int, default=150,
                                 help='size of LSTM hidden units')
     model_settings.add_argument('--max_p_num', type=int, default=6,#TODO
@@ -81,6 +100,44 @@ def parse_args():
                                 help='max length of question')
     model_settings.add_argument('--max_a_len', type=int, default=200,
                                 help='max length of answer')
+    model_settings.add_argument('--p_window_budget', type=int, default=0,
+                                help='compress longer passages to the windows with the highest '
+                                     'question overlap within this many tokens, 0 to disable')
+    model_settings.add_argument('--p_window_size', type=int, default=20,
+                                help='size of the windows used by the passage compression')
+    model_settings.add_argument('--dedup_threshold', type=float, default=0,
+                                help='drop duplicate passages of a sample at load time, 1 for exact '
+                                     'duplicates only, below 1 for near duplicates, 0 to disable')
+    model_settings.add_argument('--lazy_raw_data', action='store_true',
+                                help='keep only ids and spans of the samples in memory, and parse '
+                                     'their text again from the data files when decoding answers')
+    model_settings.add_argument('--slim_load', action='store_true',
+                                help='truncate the passages to max_p_len at load time '
+                                     'and drop the fields not used after the passage selection')
+    model_settings.add_argument('--convert_processes', type=int, default=1,
+                                help='number of processes counting the tokens of the vocab and converting them to ids')
+    model_settings.add_argument('--pack_len', type=int, default=0,
+                                help='pack the passages of a sample into rows of up to this many tokens '
+                                     '(at least max_p_len) with segment-aware layers, 0 for one row per passage')
+    model_settings.add_argument('--no_sort_eval_batches', dest='sort_eval_batches', action='store_false',
+                                help='batch the dev/test samples in the order of the files instead of '
+                                     'sorted by length, which pads less and predicts the same answers')
+    model_settings.add_argument('--check_eval_order', action='store_true',
+                                help='predict the dev/test set again in the order of the files, and check that '
+                                     'the predictions are byte-identical to the ones of the sorted batches')
+    model_settings.add_argument('--embedding_dtype', choices=['float32', 'float16'], default='float32',
+                                help='the dtype the embeddings are stored as in the vocab and the exported model')
+    model_settings.add_argument('--from_export', action='store_true',
+                                help='evaluate/predict with the model exported by --export instead of the checkpoint')
+    model_settings.add_argument('--compact_embeddings', action='store_true',
+                                help='predict with the embeddings of the tokens of the test files only, '
+                                     'the other rows are not read from the checkpoint')
+    model_settings.add_argument('--cascade_threshold', type=float, default=0,
+                                help='at inference, keep only the top passages covering this share '
+                                     'of the recall score, 0 to feed all passages')
+    model_settings.add_argument('--cascade_compare', action='store_true',
+                                help='evaluate with and without the passage cascade, '
+                                     'and report the time saved and the Rouge-L lost')
 
     path_settings = parser.add_argument_group('path settings')
     path_settings.add_argument('--train_files', nargs='+',
@@ -106,6 +163,14 @@ def parse_args():
     path_settings.add_argument('--vocab_path', default='../data/vocab/full.glove.vocab.data',#TODO!!
                                help='the path to save vocabulary')
 
+    path_settings.add_argument('--shared_data_dir', default='',
+                               help='train from the id-converted train/dev sets memory-mapped from this dir, '
+                                    'shared by concurrent trainers, the first one publishes them')
+    path_settings.add_argument('--graph_cache_dir', default='',
+                               help='import the graph of the same configuration from this dir if it was '
+                                    'cached there by a previous run, and cache it otherwise')
+    path_settings.add_argument('--result_ext', default='.json',
+                               help='extension of the result files, .json.gz/.json.bz2/.json.xz to compress them')
     path_settings.add_argument('--run_id', default='0',
                                help='Run ID [0]')
     
@@ -131,6 +196,18 @@ def parse_args():
     return args
 
 
+def dataset_options(args):
+    """
+    The BRCDataset options shared by all the running modes
+    """
+    return {'p_window_budget': args.p_window_budget,
+            'p_window_size': args.p_window_size,
+            'dedup_threshold': args.dedup_threshold,
+            'lazy_raw_data': args.lazy_raw_data,
+            'slim_load': args.slim_load,
+            'pack_len': args.pack_len}
+
+
 def prepare(args):
     """
     checks data, creates the directories, prepare the vocabulary and embeddings
@@ -143,14 +220,18 @@ def prepare(args):
     logger.info('Preparing the directories...')
     
     logger.info('Building vocabulary...')
-    brc_data = BRCDataset(args.max_p_num, args.max_p_len, args.max_q_len,
-                          args.train_files, args.dev_files, args.test_files)
-    vocab = Vocab(lower=True)
-    for word in brc_data.word_iter('train'):#构建词典只包含训练集
-        vocab.add(word)
+    # the tokens of the train samples as BRCDataset would load them, counted straight from the files
+    selector = BRCDataset(args.max_p_num, args.max_p_len, args.max_q_len, **dataset_options(args))
+    token_counts = count_tokens(args.train_files, partial(selector.sample_tokens, train=True),
+                                processes=args.convert_processes)
+    vocab = Vocab(lower=True, hash_buckets=args.hash_buckets)
+    for word, cnt in token_counts.items():#构建词典只包含训练集
+        vocab.add(word, cnt)
 
     unfiltered_vocab_size = vocab.size()
     vocab.filter_tokens_by_cnt(min_cnt=2)
+    if args.vocab_top_n > 0:
+        vocab.keep_top_tokens(args.vocab_top_n)
     filtered_num = unfiltered_vocab_size - vocab.size()
     logger.info('After filter {} tokens, the final vocab size is {}'.format(filtered_num,
                                                                             vocab.size()))
@@ -162,12 +243,21 @@ def prepare(args):
 
     logger.info('Saving vocab...')
     # with open(os.path.join(args.vocab_dir, 'vocab.data'), 'wb') as fout:
-    with open(args.vocab_path, 'wb') as fout:#不区分search&zhidao
-        pickle.dump(vocab, fout)
+    vocab.save(args.vocab_path, args.embedding_dtype)#不区分search&zhidao
 
     logger.info('Done with preparing!')
 
 
+def restore_model(rc_model, args, embedding_rows=None):
+    """
+    Restores the trained model for inference, from the checkpoint or the export
+    """
+    if args.from_export:
+        rc_model.restore_export(model_dir=args.model_dir, model_prefix=args.algo, embedding_rows=embedding_rows)
+    else:
+        rc_model.restore(model_dir=args.model_dir, model_prefix=args.algo, embedding_rows=embedding_rows)
+
+
 def train(args):
     """
     trains the reading comprehension model
@@ -175,23 +265,63 @@ def train(args):
     logger = logging.getLogger("brc")
     logger.info('Load data_set and vocab...')
     # with open(os.path.join(args.vocab_dir, 'vocab.data'), 'rb') as fin:
-    with open(args.vocab_path, 'rb') as fin:
-        vocab = pickle.load(fin)
-    brc_data = BRCDataset(args.max_p_num, args.max_p_len, args.max_q_len,
-                          args.train_files, args.dev_files)
-    logger.info('Converting text into ids...')
-    brc_data.convert_to_ids(vocab)
+    vocab = Vocab.load(args.vocab_path)
+    if args.shared_data_dir:
+        brc_data = BRCDataset(args.max_p_num, args.max_p_len, args.max_q_len, **dataset_options(args))
+        if not brc_data.attach_shared(args.shared_data_dir, vocab.token_hash()):
+            logger.info('Publishing the data_set to {}...'.format(args.shared_data_dir))
+            options = dataset_options(args)
+            options['lazy_raw_data'] = True
+            publisher = BRCDataset(args.max_p_num, args.max_p_len, args.max_q_len,
+                                   args.train_files, args.dev_files, **options)
+            publisher.convert_to_ids(vocab, args.convert_processes)
+            publisher.publish_shared(args.shared_data_dir)
+            del publisher
+            brc_data.attach_shared(args.shared_data_dir, vocab.token_hash())
+    else:
+        brc_data = BRCDataset(args.max_p_num, args.max_p_len, args.max_q_len,
+                              args.train_files, args.dev_files,
+                              **dataset_options(args))
+        logger.info('Converting text into ids...')
+        brc_data.convert_to_ids(vocab, args.convert_processes)
     logger.info('Initialize the model...')
-    rc_model = RCModel(vocab, args)
+    rc_model = RCModel(vocab, args, start_t=START_T)
+    train_state = None
     if args.restore:
         logger.info('Restoring the model...')
-        rc_model.restore(model_dir=args.model_dir, model_prefix=args.algo)
+        train_state = rc_model.restore_train_state(model_dir=args.model_dir, model_prefix=args.algo)
+        if train_state is None:
+            rc_model.restore(model_dir=args.model_dir, model_prefix=args.algo)
     logger.info('Training the model...')
     rc_model.train(brc_data, args.epochs, args.batch_size, save_dir=args.model_dir,
-                   save_prefix=args.algo, dropout_keep_prob=args.dropout_keep_prob)
+                   save_prefix=args.algo, dropout_keep_prob=args.dropout_keep_prob,
+                   eval_every_n_steps=args.eval_every_n_steps, eval_subset_size=args.eval_subset_size,
+                   save_every_n_steps=args.save_every_n_steps, train_state=train_state)
     logger.info('Done with model training!')
 
 
+def check_eval_order(rc_model, brc_data, set_name, result_prefix, sorted_time, args):
+    """
+    Predicts a set again with the batches in the order of the files, next to the predictions
+    of the batches sorted by length, and checks that both result files are byte-identical
+    """
+    logger = logging.getLogger("brc")
+    start_t = time.time()
+    batches = brc_data.gen_mini_batches(set_name, args.batch_size, pad_id=rc_model.vocab.get_id(rc_model.vocab.pad_token),
+                                        shuffle=False, sort_by_length=False)
+    rc_model.evaluate(batches, result_dir=args.result_dir, result_prefix=result_prefix + '.file_order',
+                      result_ext=args.result_ext)
+    logger.info('Sorted batches take {:.1f}s, batches in file order {:.1f}s'.format(sorted_time, time.time() - start_t))
+    # compressed files are compared decompressed, their headers hold the time they were written
+    with open_file(os.path.join(args.result_dir, result_prefix + args.result_ext), 'rb') as fin:
+        sorted_results = fin.read()
+    with open_file(os.path.join(args.result_dir, result_prefix + '.file_order' + args.result_ext), 'rb') as fin:
+        file_order_results = fin.read()
+    assert sorted_results == file_order_results, \
+        'The predictions of the sorted batches differ from the ones in file order'
+    logger.info('The predictions of the sorted batches and in file order are identical.')
+
+
 def evaluate(args):
     """
     evaluate the trained model on dev files
@@ -199,20 +329,40 @@ def evaluate(args):
     logger = logging.getLogger("brc")
     logger.info('Load data_set and vocab...')
     # with open(os.path.join(args.vocab_dir, 'vocab.data'), 'rb') as fin:
-    with open(args.vocab_path, 'rb') as fin:
-        vocab = pickle.load(fin)
+    vocab = Vocab.load(args.vocab_path)
     assert len(args.dev_files) > 0, 'No dev files are provided.'
-    brc_data = BRCDataset(args.max_p_num, args.max_p_len, args.max_q_len, dev_files=args.dev_files)
+    brc_data = BRCDataset(args.max_p_num, args.max_p_len, args.max_q_len, dev_files=args.dev_files,
+                          **dataset_options(args))
     logger.info('Converting text into ids...')
-    brc_data.convert_to_ids(vocab)
+    brc_data.convert_to_ids(vocab, args.convert_processes)
     logger.info('Restoring the model...')
-    rc_model = RCModel(vocab, args)
-    rc_model.restore(model_dir=args.model_dir, model_prefix=args.algo)
+    rc_model = RCModel(vocab, args, start_t=START_T)
+    restore_model(rc_model, args)
+    if args.cascade_threshold > 0 and args.cascade_compare:
+        logger.info('Evaluating the model on dev set without passage cascade...')
+        start_t = time.time()
+        dev_batches = brc_data.gen_mini_batches('dev', args.batch_size,
+                                                pad_id=vocab.get_id(vocab.pad_token), shuffle=False,
+                                                sort_by_length=args.sort_eval_batches)
+        _, full_bleu_rouge = rc_model.evaluate(dev_batches)
+        full_time = time.time() - start_t
+        logger.info('Result without passage cascade: {}, {:.1f}s'.format(full_bleu_rouge, full_time))
+    if args.cascade_threshold > 0:
+        brc_data.apply_passage_cascade(args.cascade_threshold, set_names=['dev'])
     logger.info('Evaluating the model on dev set...')
+    start_t = time.time()
     dev_batches = brc_data.gen_mini_batches('dev', args.batch_size,
-                                            pad_id=vocab.get_id(vocab.pad_token), shuffle=False)
+                                            pad_id=vocab.get_id(vocab.pad_token), shuffle=False,
+                                            sort_by_length=args.sort_eval_batches)
     dev_loss, dev_bleu_rouge = rc_model.evaluate(
-        dev_batches, result_dir=args.result_dir, result_prefix='dev.predicted')
+        dev_batches, result_dir=args.result_dir, result_prefix='dev.predicted', result_ext=args.result_ext)
+    dev_time = time.time() - start_t
+    logger.info('Time to evaluate the dev set: {:.1f}s'.format(dev_time))
+    if args.check_eval_order and args.sort_eval_batches:
+        check_eval_order(rc_model, brc_data, 'dev', 'dev.predicted', dev_time, args)
+    if args.cascade_threshold > 0 and args.cascade_compare:
+        logger.info('Passage cascade saves {:.1f}s of {:.1f}s, Rouge-L {} -> {}'.format(
+            full_time - dev_time, full_time, full_bleu_rouge['Rouge-L'], dev_bleu_rouge['Rouge-L']))
     logger.info('Loss on dev set: {}'.format(dev_loss))
     logger.info('Result on dev set: {}'.format(dev_bleu_rouge))
     logger.info('Predicted answers are saved to {}'.format(os.path.join(args.result_dir)))
@@ -225,21 +375,46 @@ def predict(args):
     logger = logging.getLogger("brc")
     logger.info('Load data_set and vocab...')
     # with open(os.path.join(args.vocab_dir, 'vocab.data'), 'rb') as fin:
-    with open(args.vocab_path, 'rb') as fin:
-        vocab = pickle.load(fin)
+    vocab = Vocab.load(args.vocab_path)
     assert len(args.test_files) > 0, 'No test files are provided.'
     brc_data = BRCDataset(args.max_p_num, args.max_p_len, args.max_q_len,
-                          test_files=args.test_files)
+                          test_files=args.test_files,
+                          **dataset_options(args))
+    embedding_rows = None
+    if args.compact_embeddings:
+        full_size = vocab.size()
+        vocab, embedding_rows = vocab.restrict_to(brc_data.word_iter('test'))
+        logger.info('The test set uses {} tokens of the {} in the vocab.'.format(vocab.size(), full_size))
     logger.info('Converting text into ids...')
-    brc_data.convert_to_ids(vocab)
+    brc_data.convert_to_ids(vocab, args.convert_processes)
     logger.info('Restoring the model...')
-    rc_model = RCModel(vocab, args)
-    rc_model.restore(model_dir=args.model_dir, model_prefix=args.algo)
+    rc_model = RCModel(vocab, args, start_t=START_T)
+    restore_model(rc_model, args, embedding_rows)
+    if args.cascade_threshold > 0:
+        brc_data.apply_passage_cascade(args.cascade_threshold, set_names=['test'])
     logger.info('Predicting answers for test set...')
+    start_t = time.time()
     test_batches = brc_data.gen_mini_batches('test', args.batch_size,
-                                             pad_id=vocab.get_id(vocab.pad_token), shuffle=False)
+                                             pad_id=vocab.get_id(vocab.pad_token), shuffle=False,
+                                             sort_by_length=args.sort_eval_batches)
     rc_model.evaluate(test_batches,
-                      result_dir=args.result_dir, result_prefix='test.predicted')
+                      result_dir=args.result_dir, result_prefix='test.predicted', result_ext=args.result_ext)
+    test_time = time.time() - start_t
+    logger.info('Time to predict the test set: {:.1f}s'.format(test_time))
+    if args.check_eval_order and args.sort_eval_batches:
+        check_eval_order(rc_model, brc_data, 'test', 'test.predicted', test_time, args)
+
+
+def export(args):
+    """
+    exports the trained model for inference
+    """
+    logger = logging.getLogger("brc")
+    vocab = Vocab.load(args.vocab_path)
+    rc_model = RCModel(vocab, args, start_t=START_T)
+    rc_model.restore(model_dir=args.model_dir, model_prefix=args.algo)
+    rc_model.export(model_dir=args.model_dir, model_prefix=args.algo, float16=args.embedding_dtype == 'float16')
+    logger.info('Done with exporting!')
 
 
 def run():
@@ -288,6 +463,8 @@ def run():
         evaluate(args)
     if args.predict:
         predict(args)
+    if args.export:
+        export(args)
 
 if __name__ == '__main__':
     run()
@@ -18,18 +18,137 @@
 This module implements the Vocab class for converting string to id and back
 """
 
+import os
+import sys
+import json
+import hashlib
+import pickle
+import logging
+import zlib
+import argparse
+import multiprocessing
 import numpy as np
+from itertools import chain
+
+# the version of the format written by Vocab.save, 2 adds embedding_dtype, 3 adds hash_buckets
+VOCAB_FORMAT_VERSION = 3
+# the dtypes the embeddings can be saved as, they are float32 in memory
+EMBEDDING_DTYPES = ('float32', 'float16')
+
+
+def embedding_cache_paths(embedding_path):
+    """
+    The binary copy of a text embedding file: the token list and the float32 matrix
+    """
+    return embedding_path + '.tokens', embedding_path + '.npy'
+
+
+def convert_embeddings(embedding_path):
+    """
+    Converts a text embedding file (a token and its values on each line) once into a token list
+    and a float32 .npy matrix with the same rows, which load_pretrained_embeddings memory-maps
+    Args:
+        embedding_path: the path of the text embedding file
+    Returns:
+        the paths of the token list and of the matrix
+    """
+    tokens_path, matrix_path = embedding_cache_paths(embedding_path)
+    row_num, embed_dim = 0, None
+    with open(embedding_path, 'r') as fin:
+        for line in fin:
+            contents = line.strip().split()
+            if embed_dim is None and len(contents) > 2:
+                # skips the "<token num> <dim>" header of the word2vec format
+                embed_dim = len(contents) - 1
+            if embed_dim is not None and len(contents) == embed_dim + 1:
+                row_num += 1
+    matrix = np.lib.format.open_memmap(matrix_path + '.tmp', mode='w+', dtype=np.float32,
+                                       shape=(row_num, embed_dim))
+    row = 0
+    with open(embedding_path, 'r') as fin, open(tokens_path + '.tmp', 'w') as fout:
+        for line in fin:
+            contents = line.strip().split()
+            if len(contents) != embed_dim + 1:
+                continue
+            fout.write(contents[0] + '\n')
+            matrix[row] = np.array(contents[1:], dtype=np.float32)
+            row += 1
+    matrix.flush()
+    del matrix
+    # renamed last, a half converted cache is never loaded
+    os.rename(tokens_path + '.tmp', tokens_path)
+    os.rename(matrix_path + '.tmp', matrix_path)
+    return tokens_path, matrix_path
+
+
+def stable_hash(token):
+    """
+    A hash of a token that does not change across processes and python versions,
+    unlike hash(), so that the hash bucket ids of a checkpoint stay valid
+    """
+    return zlib.crc32(token.encode('utf8')) & 0xffffffff
+
+
+class _IdTable(dict):
+    """
+    Maps a raw token to its id, the tokens seen the first time are lowercased (if the vocab is)
+    and looked up once, then answered by a plain dict lookup
+    """
+    def __init__(self, token2id, unk_id, lower, hash_buckets=0):
+        super(_IdTable, self).__init__(token2id)
+        self.token2id = token2id
+        self.unk_id = unk_id
+        self.lower = lower
+        self.hash_buckets = hash_buckets
+
+    def __missing__(self, token):
+        key = token.lower() if self.lower else token
+        idx = self.token2id.get(key)
+        if idx is None:
+            idx = len(self.token2id) + stable_hash(key) % self.hash_buckets if self.hash_buckets else self.unk_id
+        self[token] = idx
+        return idx
+
+
+def ragged_ids(id_table, token_lists):
+    """
+    Converts token lists with an id table into a ragged array
+    Returns:
+        the int32 ids of all the lists end to end, and the int64 offsets of the lists,
+        the ids of the i-th list being ids[offsets[i]: offsets[i + 1]]
+    """
+    offsets = np.zeros(len(token_lists) + 1, dtype=np.int64)
+    np.cumsum([len(tokens) for tokens in token_lists], out=offsets[1:])
+    ids = np.fromiter(map(id_table.__getitem__, chain.from_iterable(token_lists)),
+                      dtype=np.int32, count=int(offsets[-1]))
+    return ids, offsets
+
+
+# the id table of a worker process, set once by _init_worker
+_worker_id_table = None
+
+
+def _init_worker(id_table):
+    global _worker_id_table
+    _worker_id_table = id_table
+
+
+def _worker_ragged_ids(token_lists):
+    return ragged_ids(_worker_id_table, token_lists)
 
 
 class Vocab(object):
     """
     Implements a vocabulary to store the tokens in the data, with their corresponding embeddings.
     """
-    def __init__(self, filename=None, initial_tokens=None, lower=False):
+    def __init__(self, filename=None, initial_tokens=None, lower=False, hash_buckets=0):
         self.id2token = {}
         self.token2id = {}
         self.token_cnt = {}
         self.lower = lower
+        # if > 0, the tokens not in vocab share this many ids after the ids of the tokens,
+        # chosen by stable_hash, instead of the id of unk_token
+        self.hash_buckets = hash_buckets
 
         self.embed_dim = None
         self.embeddings = None
@@ -45,13 +164,96 @@ class Vocab(object):
         if filename is not None:
             self.load_from_file(filename)
 
+    def save(self, vocab_path, embedding_dtype='float32'):
+        """
+        Saves the vocab in a versioned format: <vocab_path>.json (the version and settings),
+        <vocab_path>.tokens (a token in each line, in id order), <vocab_path>.counts.npy and
+        <vocab_path>.npy (the embeddings), which load memory-maps
+        Args:
+            vocab_path: the prefix of the files
+            embedding_dtype: 'float32', or 'float16' to halve the embedding file,
+                             the embeddings are upcast to float32 by load
+        """
+        assert embedding_dtype in EMBEDDING_DTYPES, 'Unknown embedding dtype {}'.format(embedding_dtype)
+        tokens = [self.id2token[idx] for idx in range(len(self.id2token))]
+        # newline='\n' keeps the tokens that hold a '\r'
+        with open(vocab_path + '.tokens', 'w', newline='\n') as fout:
+            for token in tokens:
+                fout.write(token + '\n')
+        np.save(vocab_path + '.counts.npy', np.array([self.token_cnt.get(token, 0) for token in tokens], dtype=np.int64))
+        if self.embeddings is not None:
+            embeddings = np.asarray(self.embeddings, dtype=embedding_dtype)
+            if not np.isfinite(embeddings).all():
+                raise ValueError('The embeddings overflow {}.'.format(embedding_dtype))
+            np.save(vocab_path + '.npy', embeddings)
+        meta = {'format_version': VOCAB_FORMAT_VERSION, 'size': len(tokens), 'lower': self.lower,
+                'pad_token': self.pad_token, 'unk_token': self.unk_token,
+                'initial_tokens': self.initial_tokens, 'embed_dim': self.embed_dim,
+                'has_embeddings': self.embeddings is not None, 'embedding_dtype': embedding_dtype,
+                'hash_buckets': self.hash_buckets}
+        # written last, the vocab is not loadable before all its files are
+        with open(vocab_path + '.json', 'w') as fout:
+            json.dump(meta, fout)
+
+    @classmethod
+    def load(cls, vocab_path):
+        """
+        Loads a vocab saved by save, the float32 embeddings are memory-mapped, so they are only
+        read when used, the float16 ones are read and upcast. A vocab pickled by the previous
+        versions is still loaded
+        Args:
+            vocab_path: the prefix given to save, or the path of a pickled vocab
+        Returns:
+            a Vocab
+        """
+        if not os.path.exists(vocab_path + '.json'):
+            logging.getLogger("brc").warning(
+                '{} is a pickled vocab, python vocab.py --migrate {} converts it.'.format(vocab_path, vocab_path))
+            with open(vocab_path, 'rb') as fin:
+                vocab = pickle.load(fin)
+            vocab.__dict__.setdefault('hash_buckets', 0)
+            return vocab
+        with open(vocab_path + '.json') as fin:
+            meta = json.load(fin)
+        if meta['format_version'] > VOCAB_FORMAT_VERSION:
+            raise ValueError('{} has the vocab format {}, only {} is supported.'.format(
+                vocab_path, meta['format_version'], VOCAB_FORMAT_VERSION))
+        vocab = cls.__new__(cls)
+        vocab.lower = meta['lower']
+        vocab.pad_token, vocab.unk_token = meta['pad_token'], meta['unk_token']
+        vocab.initial_tokens = meta['initial_tokens']
+        vocab.embed_dim = meta['embed_dim']
+        vocab.hash_buckets = meta.get('hash_buckets', 0)
+        with open(vocab_path + '.tokens', 'r', newline='\n') as fin:
+            tokens = [line[:-1] for line in fin]
+        assert len(tokens) == meta['size'], '{}.tokens is truncated'.format(vocab_path)
+        vocab.id2token = dict(enumerate(tokens))
+        vocab.token2id = {token: idx for idx, token in enumerate(tokens)}
+        vocab.token_cnt = dict(zip(tokens, np.load(vocab_path + '.counts.npy').tolist()))
+        vocab.embeddings = None
+        if meta['has_embeddings']:
+            vocab.embeddings = np.load(vocab_path + '.npy', mmap_mode='r')
+            if meta.get('embedding_dtype', 'float32') != 'float32':
+                vocab.embeddings = vocab.embeddings.astype(np.float32)
+        return vocab
+
     def size(self):
         """
-        get the size of vocabulary
+        get the size of vocabulary, the hash buckets included
         Returns:
             an integer indicating the size
         """
-        return len(self.id2token)
+        return len(self.id2token) + self.hash_buckets
+
+    def token_hash(self):
+        """
+        The md5 of the tokens in the order of their ids, with the options mapping the other tokens
+        to ids, two vocabs with the same hash convert any text to the same ids
+        """
+        md5 = hashlib.md5(json.dumps({'lower': self.lower, 'hash_buckets': self.hash_buckets}).encode('utf8'))
+        for idx in range(len(self.id2token)):
+            md5.update(self.id2token[idx].encode('utf8') + b'\n')
+        return md5.hexdigest()
 
     def load_from_file(self, file_path):
         """
@@ -65,7 +267,8 @@ class Vocab(object):
 
     def get_id(self, token):
         """
-        gets the id of a token, returns the id of unk token if token is not in vocab
+        gets the id of a token, returns the id of unk token if token is not in vocab,
+        or the id of its hash bucket if the vocab has hash buckets
         Args:
             key: a string indicating the word
         Returns:
@@ -75,11 +278,14 @@ class Vocab(object):
         try:
             return self.token2id[token]
         except KeyError:
+            if self.hash_buckets:
+                return len(self.id2token) + stable_hash(token) % self.hash_buckets
             return self.token2id[self.unk_token]
 
     def get_token(self, idx):
         """
         gets the token corresponding to idx, returns unk token if idx is not in vocab
+        or is a hash bucket
         Args:
             idx: an integer
         returns:
@@ -126,6 +332,24 @@ class Vocab(object):
         for token in filtered_tokens:
             self.add(token, cnt=0)
 
+    def keep_top_tokens(self, top_n):
+        """
+        keeps the top_n most frequent tokens (besides the initial tokens), in their order,
+        for a vocab whose long tail goes to the hash buckets
+        Args:
+            top_n: the number of tokens to keep
+        """
+        tokens = [token for token in self.token2id if token not in self.initial_tokens]
+        kept = set(sorted(tokens, key=lambda token: -self.token_cnt.get(token, 0))[:top_n])
+        # rebuild the token x id map
+        self.token2id = {}
+        self.id2token = {}
+        for token in self.initial_tokens:
+            self.add(token, cnt=0)
+        for token in tokens:
+            if token in kept:
+                self.add(token, cnt=0)
+
     def randomly_init_embeddings(self, embed_dim):
         """
         randomly initializes the embeddings for each token
@@ -133,17 +357,26 @@ class Vocab(object):
             embed_dim: the size of the embedding for each token
         """
         self.embed_dim = embed_dim
-        self.embeddings = np.random.rand(self.size(), embed_dim)
+        self.embeddings = np.random.rand(self.size(), embed_dim).astype(np.float32)
         for token in [self.pad_token, self.unk_token]:
             self.embeddings[self.get_id(token)] = np.zeros([self.embed_dim])
 
-    def load_pretrained_embeddings(self, embedding_path):
+    def load_pretrained_embeddings(self, embedding_path, use_cache=True):
         """
         loads the pretrained embeddings from embedding_path,
         tokens not in pretrained embeddings will be filtered
         Args:
             embedding_path: the path of the pretrained embedding file
+            use_cache: if True, the file is converted once by convert_embeddings
+                       and its binary copy is loaded instead
         """
+        tokens_path, matrix_path = embedding_cache_paths(embedding_path)
+        if use_cache:
+            if not os.path.exists(matrix_path) or \
+                    os.path.getmtime(matrix_path) < os.path.getmtime(embedding_path):
+                convert_embeddings(embedding_path)
+            self.load_binary_embeddings(tokens_path, matrix_path)
+            return
         trained_embeddings = {}
         with open(embedding_path, 'r') as fin:
             for line in fin:
@@ -164,11 +397,46 @@ class Vocab(object):
         for token in filtered_tokens:
             self.add(token, cnt=0)
         # load embeddings
-        self.embeddings = np.zeros([self.size(), self.embed_dim])
+        self.embeddings = np.zeros([self.size(), self.embed_dim], dtype=np.float32)
         for token in self.token2id.keys():
             if token in trained_embeddings:
                 self.embeddings[self.get_id(token)] = trained_embeddings[token]
 
+    def load_binary_embeddings(self, tokens_path, matrix_path):
+        """
+        loads the pretrained embeddings converted by convert_embeddings, the matrix is memory-mapped
+        and only the rows of the tokens in vocab are read, tokens not in pretrained embeddings
+        will be filtered as load_pretrained_embeddings does
+        Args:
+            tokens_path: the token list, a token in each line
+            matrix_path: the float32 matrix, a row for each line of the token list
+        """
+        matrix = np.load(matrix_path, mmap_mode='r')
+        self.embed_dim = matrix.shape[1]
+        token_rows = {}
+        with open(tokens_path, 'r') as fin:
+            for row, line in enumerate(fin):
+                token = line.rstrip('\n')
+                if token in self.token2id:
+                    # a repeated token keeps its first position and its last values, as in the text file
+                    token_rows[token] = row
+        filtered_tokens = list(token_rows.keys())
+        # rebuild the token x id map
+        self.token2id = {}
+        self.id2token = {}
+        for token in self.initial_tokens:
+            self.add(token, cnt=0)
+        for token in filtered_tokens:
+            self.add(token, cnt=0)
+        # load embeddings
+        self.embeddings = np.zeros([self.size(), self.embed_dim], dtype=np.float32)
+        if filtered_tokens:
+            ids = np.array([self.get_id(token) for token in filtered_tokens], dtype=np.int64)
+            rows = np.array([token_rows[token] for token in filtered_tokens], dtype=np.int64)
+            order = np.argsort(rows)
+            # rows read in file order, so the mapped pages are scanned once
+            self.embeddings[ids[order]] = matrix[rows[order]]
+
     def convert_to_ids(self, tokens):
         """
         Convert a list of tokens to ids, use unk_token if the token is not in vocab.
@@ -180,6 +448,67 @@ class Vocab(object):
         vec = [self.get_id(label) for label in tokens]
         return vec
 
+    def restrict_to(self, tokens):
+        """
+        Builds a compact vocab holding only the given tokens (after the lowercasing and the unk
+        fallback of get_id) and the initial tokens, e.g. the tokens of a test set, the ids
+        are renumbered but the order of the tokens is kept
+        Args:
+            tokens: an iterable of tokens
+        Returns:
+            the compact vocab, and the id in this vocab of each token of the compact one,
+            i.e. the rows of the full embedding table to load
+        """
+        used_ids = set(self.get_id(token) for token in self.initial_tokens)
+        used_ids.update(self.get_id(token) for token in tokens)
+        compact = Vocab(initial_tokens=[token for token in self.initial_tokens
+                                        if token not in [self.pad_token, self.unk_token]],
+                        lower=self.lower, hash_buckets=self.hash_buckets)
+        # the hash buckets are all kept, they follow the tokens in both vocabs
+        for idx in sorted(idx for idx in used_ids if idx < len(self.id2token)):
+            token = self.id2token[idx]
+            compact.add(token, cnt=0)
+            compact.token_cnt[token] = self.token_cnt.get(token, 0)
+        rows = np.array([self.token2id[compact.id2token[idx]] for idx in range(len(compact.id2token))] +
+                        list(range(len(self.id2token), self.size())), dtype=np.int64)
+        compact.embed_dim = self.embed_dim
+        if self.embeddings is not None:
+            compact.embeddings = np.asarray(self.embeddings[rows])
+        return compact, rows
+
+    def id_table(self):
+        """
+        Builds the lookup table of convert_batch_to_ids, it is only valid until the vocab changes
+        """
+        return _IdTable(self.token2id, self.token2id[self.unk_token], self.lower, self.hash_buckets)
+
+    def convert_batch_to_ids(self, token_lists, processes=1, chunk_size=10000):
+        """
+        Converts many token lists to ids at once, with the same ids as convert_to_ids.
+        The lookup table is built once for the batch, so each token costs a dict lookup
+        Args:
+            token_lists: a list of token lists
+            processes: if > 1, the lists are converted by a pool of processes in chunks
+            chunk_size: the number of lists sent to a process at a time
+        Returns:
+            the int32 ids of all the lists end to end, and the int64 offsets of the lists,
+            the ids of the i-th list being ids[offsets[i]: offsets[i + 1]]
+        """
+        id_table = self.id_table()
+        if processes <= 1 or len(token_lists) <= chunk_size:
+            return ragged_ids(id_table, token_lists)
+        chunks = [token_lists[start: start + chunk_size] for start in range(0, len(token_lists), chunk_size)]
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(id_table,))
+        try:
+            results = pool.map(_worker_ragged_ids, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        ids = np.concatenate([chunk_ids for chunk_ids, _ in results])
+        offsets = np.zeros(len(token_lists) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate([np.diff(chunk_offsets) for _, chunk_offsets in results]), out=offsets[1:])
+        return ids, offsets
+
     def recover_from_ids(self, ids, stop_id=None):
         """
         Convert a list of ids to tokens, stop converting if the stop_id is encountered
@@ -195,3 +524,21 @@ class Vocab(object):
             if stop_id is not None and i == stop_id:
                 break
         return tokens
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Convert the embeddings or the vocab to their binary formats')
+    parser.add_argument('embedding_path', nargs='?',
+                        help='a text embedding file to convert once, e.g. ../data/glove/vectors.txt')
+    parser.add_argument('--migrate', nargs='+', default=[],
+                        help='pickled vocabs to save in the format of Vocab.save, under the same paths')
+    parser.add_argument('--embedding_dtype', choices=EMBEDDING_DTYPES, default='float32',
+                        help='the dtype of the migrated embeddings')
+    args = parser.parse_args()
+    if args.embedding_path:
+        for path in convert_embeddings(args.embedding_path):
+            print('Saved {}'.format(path))
+    for vocab_path in args.migrate:
+        with open(vocab_path, 'rb') as fin:
+            pickle.load(fin).save(vocab_path, args.embedding_dtype)
+        print('Migrated {}'.format(vocab_path))
@@ -27,10 +27,16 @@ from .dureader_eval import compute_bleu_rouge
 from .dureader_eval import normalize
 from .preprocess import find_fake_answer
 from .preprocess import find_best_question_match
+from .file_utils import open_file
+from .file_utils import is_compressed
+from .vocab_builder import count_tokens
 
 __all__ = [
     'compute_bleu_rouge',
     'normalize',
     'find_fake_answer',
     'find_best_question_match',
+    'open_file',
+    'is_compressed',
+    'count_tokens',
     ]
@@ -27,6 +27,7 @@ import zipfile
 from collections import Counter
 from .bleu_metric.bleu import Bleu
 from .rouge_metric.rouge import Rouge
+from .file_utils import open_file
 
 EMPTY = ''
 YESNO_LABELS = set(['Yes', 'No', 'Depends'])
@@ -97,7 +98,7 @@ def read_file(file_name, task, is_ref=False):
     def _open(file_name, mode, zip_obj=None):
         if zip_obj is not None:
             return zip_obj.open(file_name, mode)
-        return open(file_name, mode)
+        return open_file(file_name, mode)
 
     results = {}
     keys = ['answers', 'yesno_answers', 'entity_answers', 'question_type']
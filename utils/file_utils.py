@@ -0,0 +1,113 @@
+# -*- coding:utf8 -*-
+"""
+This module opens the jsonl data files, plain or compressed, the compression is chosen
+by the file extension: .gz, .bz2 or .xz.
+
+Run this module on a data file to compare the size and the read / write time of each
+compression, e.g. python file_utils.py ../data/preprocessed/trainset/search.train.json
+"""
+
+import bz2
+import gzip
+import json
+import os
+import sys
+import time
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2', '.xz')
+
+
+def is_compressed(file_name):
+    """
+    Checks whether a file is opened through a decompressor
+    """
+    return os.path.splitext(file_name)[1] in COMPRESSED_EXTENSIONS
+
+
+def splitext(file_name):
+    """
+    Splits a file name like os.path.splitext, but keeps the compression extension with
+    the data extension, e.g. search.train.json.gz gives (search.train, .json.gz),
+    so that the derived file names are compressed in the same way
+    """
+    root, ext = os.path.splitext(file_name)
+    if ext in COMPRESSED_EXTENSIONS:
+        root, data_ext = os.path.splitext(root)
+        ext = data_ext + ext
+    return root, ext
+
+
+def open_file(file_name, mode='r', level=None):
+    """
+    Opens a plain or compressed file
+    Args:
+        file_name: the file to open, compressed if it ends with .gz, .bz2 or .xz
+        mode: 'r', 'w' or 'a', with 'b' for bytes, the compressed text is utf-8
+        level: compression level for writing, 1 (fast) to 9 (small), default of each codec if None
+    Returns:
+        a file object
+    """
+    ext = os.path.splitext(file_name)[1]
+    if ext not in COMPRESSED_EXTENSIONS:
+        return open(file_name, mode)
+    if 'b' not in mode and 't' not in mode:
+        mode += 't'
+    kwargs = {'encoding': 'utf-8'} if 't' in mode else {}
+    if ext == '.gz':
+        if level is not None:
+            kwargs['compresslevel'] = level
+        return gzip.open(file_name, mode, **kwargs)
+    if ext == '.bz2':
+        if level is not None:
+            kwargs['compresslevel'] = level
+        return bz2.open(file_name, mode, **kwargs)
+    if lzma is None:
+        raise ImportError('The lzma module is needed to open {}'.format(file_name))
+    if level is not None and 'r' not in mode:
+        kwargs['preset'] = level
+    return lzma.open(file_name, mode, **kwargs)
+
+
+def benchmark(data_path, out_dir=None, levels=(1, 6, 9)):
+    """
+    Writes a data file with each compression, then reads and parses it back
+    Args:
+        data_path: a jsonl data file
+        out_dir: where to write the compressed copies, next to data_path if None
+        levels: compression levels to compare
+    """
+    with open_file(data_path) as fin:
+        lines = fin.readlines()
+    out_root = os.path.join(out_dir or os.path.dirname(data_path) or '.',
+                            os.path.basename(splitext(data_path)[0]) + '.benchmark')
+    print('{} samples, {:.1f}MB'.format(len(lines), os.path.getsize(data_path) / 1e6))
+    for ext, ext_levels in [('', [None])] + [(ext, levels) for ext in COMPRESSED_EXTENSIONS]:
+        if ext == '.xz' and lzma is None:
+            continue
+        for level in ext_levels:
+            out_path = out_root + '.json' + ext
+            start_t = time.time()
+            with open_file(out_path, 'w', level) as fout:
+                fout.writelines(lines)
+            write_t = time.time() - start_t
+            start_t = time.time()
+            with open_file(out_path) as fin:
+                for line in fin:
+                    pass
+            read_t = time.time() - start_t
+            start_t = time.time()
+            with open_file(out_path) as fin:
+                for line in fin:
+                    json.loads(line)
+            parse_t = time.time() - start_t
+            print('{:5s} level {:4s} {:8.1f}MB  write {:6.2f}s  read {:6.2f}s  read+parse {:6.2f}s'.format(
+                ext or 'plain', str(level), os.path.getsize(out_path) / 1e6, write_t, read_t, parse_t))
+            os.remove(out_path)
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1])
@@ -21,12 +21,12 @@ Utility function to generate vocabulary file.
 
 import argparse
 import sys
-import json
+sys.path.append('..')
 
-from itertools import chain
+from utils.vocab_builder import count_tokens
 
 
-def get_vocab(files, vocab_file):
+def get_vocab(files, vocab_file, min_cnt=1, processes=1):
     """
     Builds vocabulary file from field 'segmented_paragraphs'
     and 'segmented_question'.
@@ -34,26 +34,17 @@ def get_vocab(files, vocab_file):
     Args:
         files: A list of file names.
         vocab_file: The file that stores the vocabulary.
+        min_cnt: The tokens counted less than min_cnt times are dropped.
+        processes: The number of processes counting the tokens.
     """
-    vocab = {}
-    for f in files:
-        with open(f, 'r') as fin:
-            for line in fin:
-                obj = json.loads(line.strip())
-                paras = [
-                        chain(*d['segmented_paragraphs'])
-                        for d in obj['documents']]
-                doc_tokens = chain(*paras)
-                question_tokens = obj['segmented_question']
-                for t in list(doc_tokens) + question_tokens:
-                    vocab[t] = vocab.get(t, 0) + 1
+    vocab = count_tokens(files, processes=processes)
     # output
-    sorted_vocab = sorted([(v, c) for v, c in vocab.items()],
+    sorted_vocab = sorted([(v, c) for v, c in vocab.items() if c >= min_cnt],
             key=lambda x: x[1],
             reverse=True)
     with open(vocab_file, 'w') as outf:
         for w, c in sorted_vocab:
-            print >> outf, '{}\t{}'.format(w.encode('utf8'), c)
+            outf.write('{}\t{}\n'.format(w, c))
 
 
 if __name__ == '__main__':
@@ -62,6 +53,9 @@ if __name__ == '__main__':
             help='file list to count vocab from.')
     parser.add_argument('--vocab', required=True,
             help='file to store counted vocab.')
+    parser.add_argument('--min_cnt', type=int, default=1,
+            help='minimal count of a token to keep.')
+    parser.add_argument('--processes', type=int, default=1,
+            help='number of processes counting the tokens.')
     args = parser.parse_args()
-    get_vocab(args.files, args.vocab)
-
+    get_vocab(args.files, args.vocab, args.min_cnt, args.processes)
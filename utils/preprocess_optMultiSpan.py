@@ -10,6 +10,7 @@ import json
 import multiprocessing as multiprocess
 from collections import Counter
 import time
+from file_utils import open_file, splitext
 
 #优化效率后的通过f1找多fake span(为原数据集中的每个answer都找到对应的最匹配的fake span)
 #处理最新训练集-27w
@@ -125,13 +126,13 @@ if __name__ == '__main__':
 	for train_file in args.train_files:
 		i = 0
 		work = list()
-		with open(train_file,'r') as f_in:
+		with open_file(train_file,'r') as f_in:
 			(filepath, tempfilename) = os.path.split(train_file)
-			(train_filename, extension) = os.path.splitext(tempfilename)
+			(train_filename, extension) = splitext(tempfilename)
 			out_filename = train_filename+'_multi_fakespan_opt'+extension
 			out_file_path=os.path.join(filepath, out_filename)
 			
-			with open(out_file_path,'w') as f_out:
+			with open_file(out_file_path,'w') as f_out:
 				with multiprocess.Pool(args.n_processes) as pool:
 					for line in f_in:
 						if i < 5000:
@@ -31,7 +31,8 @@ import time
 from nltk.corpus import stopwords
 from sklearn.feature_extraction.text import TfidfVectorizer
 
-from score_func_quesmatch_feat_extract_ml import scoreParag_ml, lr_predict_forTOP5
+from score_func_quesmatch_feat_extract_ml import scoreParag_ml, lr_predict_forTOP5, join_top5_paragraphs
+from file_utils import open_file
 
 # #全局变量
 tfidfObj = TfidfVectorizer(sublinear_tf = True, max_df = 0.5, stop_words=stopwords.words('chinese'))
@@ -41,7 +42,7 @@ def genet_tfidfObj(args):
     #debug
     # for data_path in args.demo_files:
     for data_path in args.train_files + args.dev_files + args.test_files:
-        with open(data_path) as f_in:
+        with open_file(data_path) as f_in:
             for line in f_in:
                 sample = json.loads(line)
                 text.append(' '.join(sample['segmented_question']))#加入问题
@@ -110,6 +111,9 @@ def parse_args():
     path_settings.add_argument('--test_quesMatchML_top5Paths', nargs='+',
                                default=['../data/preprocessed/testset/search.test_quesMatchML_top5Pids.json'])
 
+    path_settings.add_argument('--test_joinedPaths', nargs='+', default=[],
+                               help='optional, pre-joined compact test files, one per test file')
+
     path_settings.add_argument('--LR_modeldir', default='manual_analysis/quesMatch_ml_models/', help='containing SC model and LR model')
 
     parser.add_argument('-n', '--n_processes', type=int, default=8,
@@ -341,8 +345,10 @@ if __name__ == '__main__':
 
     #test_file
     print('start deal with testset...')
-    for test_featurePath, test_qid2featLidxPath, test_quesMatchML_top5Path in zip(args.test_featurePaths, args.test_qid2featLidxPaths, args.test_quesMatchML_top5Paths):
+    for odr, (test_featurePath, test_qid2featLidxPath, test_quesMatchML_top5Path) in enumerate(zip(args.test_featurePaths, args.test_qid2featLidxPaths, args.test_quesMatchML_top5Paths)):
         lr_predict_forTOP5(test_featurePath, test_qid2featLidxPath, args.LR_modeldir, test_quesMatchML_top5Path)
+        if args.test_joinedPaths:
+            join_top5_paragraphs(args.test_files[odr], test_quesMatchML_top5Path, args.test_joinedPaths[odr])
 
         print('done with 1 file')
         time_elapsed = time.time()-start
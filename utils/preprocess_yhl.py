@@ -33,6 +33,10 @@ from sklearn.feature_extraction.text import TfidfVectorizer
 
 #score_funcs中的函数全局选篇章和span
 from score_funcs import scoreParag_recall, scoreParag_tfidf, scoreParag_ml, scoreSpan
+from file_utils import open_file, splitext
+
+#设置了--bake_files时为BRCDataset，直接写出最终的训练记录，由init_baker在每个进程中设置
+baker = None
 
 # #全局变量
 tfidfObj = TfidfVectorizer(sublinear_tf = True, max_df = 0.5, stop_words=stopwords.words('chinese'))
@@ -42,7 +46,7 @@ def genet_tfidfObj(args):
     #debug
     # for data_path in args.demo_files:
     for data_path in args.train_files + args.dev_files + args.test_files:
-        with open(data_path) as f_in:
+        with open_file(data_path) as f_in:
             for line in f_in:
                 sample = json.loads(line)
                 text.append(' '.join(sample['segmented_question']))#加入问题
@@ -88,6 +92,15 @@ def parse_args():
                                default=['../data/preprocessed/testset_v1/search.test.json'],
                                help='list of files that contain the preprocessed test data')
     
+    path_settings.add_argument('--bake_files', nargs='+', default=[],
+                               help='files to write as baked records (selected passages, fake span, '
+                                    'question tokens and metadata) instead of the scored samples, '
+                                    'the a mode bakes train records, the q mode dev/test records')
+
+    parser.add_argument('--max_p_len', type=int, default=500,
+                        help='baked passages are truncated to this length, '
+                             'not lower than the max_p_len used for training')
+
     parser.add_argument('--k', type=int, default=3,
                         help="Number of top scored spans to save")
 
@@ -134,8 +147,54 @@ def score_func(params):
     # print('start delete useless data')
     delete_useless(sample, is_train)
 
+    #finally select the passages as BRCDataset does
+    if baker is not None:
+        sample = baker.bake_sample(sample, is_train)
+        if sample is None:
+            return None
+
     return json.dumps(sample, ensure_ascii=False)
 
+def init_baker(max_p_len):
+    """
+    Sets the BRCDataset that bakes the samples in a pool process, so the workers do not
+    depend on inheriting it from the main process (no fork under spawn, or when imported)
+    """
+    global baker
+    utils_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(utils_dir, '..'))
+    sys.path.append(os.path.join(utils_dir, '..', 'tensorflow'))
+    from dataset import BRCDataset
+    baker = BRCDataset(5, max_p_len, 0)
+
+def bake_file(data_file, args):
+    """
+    Scores the samples of data_file and writes their baked records to <name>_baked<ext>,
+    the dropped samples are not written
+    """
+    is_train = args.parag_selectMode == 'a'
+    (filepath, tempfilename) = os.path.split(data_file)
+    (filename, extension) = splitext(tempfilename)
+    out_file_path = os.path.join(filepath, filename+'_'+args.parag_scoreFunc+'_baked'+extension)
+    total_line, write_line = 0, 0
+    with open_file(data_file) as f_in:
+        with open_file(out_file_path, 'w') as f_out:
+            with multiprocess.Pool(args.n_processes, initializer=init_baker, initargs=(args.max_p_len,)) as pool:
+                work = list()
+                for line in f_in:
+                    total_line += 1
+                    work.append((line, args, is_train))
+                    if len(work) == 5000:
+                        records = [r for r in pool.map(score_func, work) if r is not None]
+                        f_out.writelines(r+'\n' for r in records)
+                        write_line += len(records)
+                        work = list()
+                if work:
+                    records = [r for r in pool.map(score_func, work) if r is not None]
+                    f_out.writelines(r+'\n' for r in records)
+                    write_line += len(records)
+    print('baked {} of {} samples to {}'.format(write_line, total_line, out_file_path))
+
 def delete_useless(sample, is_train):
     """
     delete some unuseful data in sample
@@ -156,7 +215,7 @@ def _load_dataset(data_path, train=False):
     Args:
         data_path: the data file to load
     """
-    with open(data_path) as fin:
+    with open_file(data_path) as fin:
         data_set = []
         for lidx, line in enumerate(fin):
             sample = json.loads(line.strip())
@@ -222,6 +281,17 @@ if __name__ == '__main__':
     if args.parag_scoreFunc in ['tfidf', 'ml']:
         genet_tfidfObj(args)
 
+    #只写出最终的训练记录，选篇章的逻辑在tensorflow/dataset.py
+    if args.bake_files:
+        if args.parag_scoreFunc != 'recall':#BRCDataset按recall分数选篇章
+            raise NotImplementedError(args.parag_scoreFunc)
+        for data_file in args.bake_files:
+            bake_file(data_file, args)
+        time_elapsed = time.time()-start
+        print('Baking complete in {:.0f}min-{:.0f}s'.format(
+            time_elapsed // 60, time_elapsed % 60))
+        sys.exit(0)
+
     # #从文件读入
     # for demo_file in args.demo_files:
     #     i = 0
@@ -337,12 +407,12 @@ if __name__ == '__main__':
         work = list()
         total_line=0
         write_line=0
-        with open(test_file) as f_in:
+        with open_file(test_file) as f_in:
             (filepath, tempfilename) = os.path.split(test_file)
-            (test_filename, extension) = os.path.splitext(tempfilename)
+            (test_filename, extension) = splitext(tempfilename)
             out_filename = test_filename+'_'+args.parag_scoreFunc+extension
             out_file_path=os.path.join(filepath, out_filename)
-            with open(out_file_path, 'w') as f_out:
+            with open_file(out_file_path, 'w') as f_out:
                 with multiprocess.Pool(args.n_processes) as pool:
                     for line in f_in:
                         total_line+=1
@@ -32,6 +32,7 @@ from nltk.corpus import stopwords
 from sklearn.feature_extraction.text import TfidfVectorizer
 
 from score_funcs import scoreParag_recall, scoreParag_tfidf, scoreParag_ml, scoreSpan
+from file_utils import open_file, splitext
 
 #处理训练集中新增的9w数据---全局选para和span，但鉴于span用f1选，所以做了优化，不仅选多answer span，并且为每个answer选对应的多个answer span
 #处理结果为了减少I/O，仅保存结果
@@ -46,7 +47,7 @@ def genet_tfidfObj(args):
     # for data_path in args.train_files + args.dev_files + args.test_files:
     #debug
     for data_path in args.demo_files:
-        with open(data_path) as f_in:
+        with open_file(data_path) as f_in:
             for line in f_in:
                 sample = json.loads(line)
                 text.append(' '.join(sample['segmented_question']))#加入问题
@@ -158,12 +159,12 @@ if __name__ == '__main__':
     for train_file in args.train_Qids_toDeal_files:
         i = 0
         work = list()
-        with open(train_file, 'r') as f_in:
+        with open_file(train_file, 'r') as f_in:
             (filepath, tempfilename) = os.path.split(train_file)
-            (train_filename, extension) = os.path.splitext(tempfilename)
+            (train_filename, extension) = splitext(tempfilename)
             out_filename = train_filename+'_'+args.parag_scoreFunc+'_'+args.span_scoreFunc+extension
             out_file_path=os.path.join(filepath, out_filename)
-            with open(out_file_path, 'w') as f_out:
+            with open_file(out_file_path, 'w') as f_out:
                 with multiprocess.Pool(args.n_processes) as pool:
                     for line in f_in:
                         if i < 5000:
@@ -31,6 +31,7 @@ import time
 from nltk.corpus import stopwords
 from sklearn.feature_extraction.text import TfidfVectorizer
 import re
+from file_utils import open_file, splitext
 
 
 #全局变量
@@ -122,14 +123,14 @@ if __name__ == '__main__':
     #从文件读入
     for train_file in args.train_files:
         (filepath, tempfilename) = os.path.split(train_file)
-        (train_filename, extension) = os.path.splitext(tempfilename)
+        (train_filename, extension) = splitext(tempfilename)
         out_filename = train_filename+'_'+args.parag_scoreFunc+'_'+args.span_scoreFunc+'_v0'+extension
         reviewd_out_filename = train_filename+'_'+args.parag_scoreFunc+'_'+args.span_scoreFunc+extension
         out_file_path=os.path.join(filepath, out_filename)
         reviewd_out_file_path=os.path.join(filepath, reviewd_out_filename)
         l_idx=0
-        with open(out_file_path, 'r') as f_in:
-            with open(reviewd_out_file_path, 'w') as f_out:
+        with open_file(out_file_path, 'r') as f_in:
+            with open_file(reviewd_out_file_path, 'w') as f_out:
                 for line in f_in:
                     pos = [m.start() for m in re.finditer(rule_train, line)]
                     if len(pos)==2:
@@ -146,13 +147,13 @@ if __name__ == '__main__':
     #dev_file
     for dev_file in args.dev_files:
         (filepath, tempfilename) = os.path.split(dev_file)
-        (dev_filename, extension) = os.path.splitext(tempfilename)
+        (dev_filename, extension) = splitext(tempfilename)
         out_filename = dev_filename+'_'+args.parag_scoreFunc+'_'+args.span_scoreFunc+'_v0'+extension
         reviewd_out_filename = dev_filename+'_'+args.parag_scoreFunc+'_'+args.span_scoreFunc+extension
         out_file_path=os.path.join(filepath, out_filename)
         reviewd_out_file_path=os.path.join(filepath, reviewd_out_filename)
-        with open(out_file_path, 'r') as f_in:
-            with open(reviewd_out_file_path, 'w') as f_out:
+        with open_file(out_file_path, 'r') as f_in:
+            with open_file(reviewd_out_file_path, 'w') as f_out:
                 for line in f_in:
                     pos = [m.start() for m in re.finditer(rule_train, line)]
                     if len(pos)==2:
@@ -4,6 +4,7 @@ if sys.version[0] == '2':
 	reload(sys)
 	sys.setdefaultencoding("utf-8")
 
+import os
 from collections import Counter
 import json
 import numpy as np
@@ -11,6 +12,9 @@ from sklearn.metrics import pairwise_distances
 from nltk.translate.bleu_score import sentence_bleu
 from nltk.corpus import stopwords
 from sklearn.externals import joblib
+from file_utils import open_file
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tensorflow'))
+from paragraph_selection import load_top_paragraph_ids, gather_paragraphs
 
 def precision_recall_f1(prediction, ground_truth):
 	"""
@@ -95,9 +99,9 @@ def scoreParag_ml(sample, tfidfObj):
 
 def lr_predict_forTOP5(feature_path, qid2featLidx_path, model_dir, out_path):
 
-	with open(feature_path, "r") as fr1:
-		with open(qid2featLidx_path, "r") as fr2:
-			with open(out_path, "w") as fw:
+	with open_file(feature_path, "r") as fr1:
+		with open_file(qid2featLidx_path, "r") as fr2:
+			with open_file(out_path, "w") as fw:
 				for line in fr1:#每行是一个样本的数据
 					feature_list = json.loads(line)
 					qid2featLidx = json.loads(fr2.readline())
@@ -136,3 +140,25 @@ def lr_predict_forTOP5(feature_path, qid2featLidx_path, model_dir, out_path):
 
 					rst={'question_id':question_id, 'top5_para_ids':top5_para_ids.tolist()}
 					fw.write(json.dumps(rst)+'\n')
+
+def join_top5_paragraphs(data_path, top5Pid_path, out_path):
+	"""
+	Writes a compact copy of the data file, the documents of each sample are replaced by
+	the paragraphs selected in top5Pid_path, so the dataset can load it without the join
+	Args:
+		data_path: the preprocessed data file
+		top5Pid_path: the file written by lr_predict_forTOP5
+		out_path: the pre-joined file to write
+	"""
+	top5Pids = load_top_paragraph_ids(top5Pid_path)#question_id -> [[d_idx, p_idx], ...]
+
+	with open_file(data_path, "r") as fin:
+		with open_file(out_path, "w") as fw:
+			for line in fin:
+				sample = json.loads(line)
+				documents = sample.pop('documents')
+				sample['passages'] = []
+				if len(documents) != 0:
+					for passage_tokens in gather_paragraphs(documents, top5Pids[sample['question_id']]):
+						sample['passages'].append({'passage_tokens': passage_tokens})
+				fw.write(json.dumps(sample, ensure_ascii=False)+'\n')
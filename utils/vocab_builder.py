@@ -0,0 +1,102 @@
+# -*- coding:utf8 -*-
+"""
+This module counts the tokens of jsonl data files for building the vocabulary, the files are
+streamed by a pool of processes, each counting a byte range of a file into its own Counter,
+so the memory depends on the number of distinct tokens and not on the size of the data.
+The merged Counter keeps the tokens in the order of their first occurrence in the files,
+as adding them to a Vocab one sample at a time would.
+"""
+
+import json
+import multiprocessing
+import os
+from collections import Counter
+from itertools import chain
+
+from .file_utils import open_file, is_compressed
+
+
+def document_tokens(sample):
+    """
+    The question tokens and the tokens of all the paragraphs of all the documents of a sample
+    """
+    paragraphs = chain.from_iterable(doc['segmented_paragraphs'] for doc in sample['documents'])
+    return chain(sample['segmented_question'], chain.from_iterable(paragraphs))
+
+
+def split_file(data_path, chunk_num):
+    """
+    Splits a file into byte ranges, a line belongs to the range in which it starts,
+    a compressed file cannot be seeked into and is a single range
+    Returns:
+        a list of (start, end), end is None for the end of the file
+    """
+    if chunk_num <= 1 or is_compressed(data_path):
+        return [(0, None)]
+    size = os.path.getsize(data_path)
+    bounds = [size * idx // chunk_num for idx in range(chunk_num)] + [None]
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start != end]
+
+
+def count_range(data_path, start, end, sample_tokens):
+    """
+    Counts the tokens of the samples starting in a byte range of a file
+    Args:
+        data_path: a jsonl data file
+        start, end: the byte range, end is None for the end of the file
+        sample_tokens: maps a sample to its tokens, a sample mapped to None is skipped
+    Returns:
+        a Counter
+    """
+    counter = Counter()
+    with open_file(data_path, 'rb') as fin:
+        pos = start
+        if start > 0:
+            # the line running over start belongs to the previous range
+            fin.seek(start - 1)
+            pos = start - 1 + len(fin.readline())
+        while end is None or pos < end:
+            line = fin.readline()
+            if not line:
+                break
+            pos += len(line)
+            if not line.strip():
+                continue
+            tokens = sample_tokens(json.loads(line))
+            if tokens is not None:
+                counter.update(tokens)
+    return counter
+
+
+def _count_task(task):
+    return count_range(*task)
+
+
+def count_tokens(data_files, sample_tokens=document_tokens, processes=1, chunks_per_process=4):
+    """
+    Counts the tokens of some jsonl data files
+    Args:
+        data_files: the data files, plain or compressed
+        sample_tokens: maps a sample to its tokens, a sample mapped to None is skipped,
+                       it must be picklable when processes > 1, e.g. a module function or a bound method
+        processes: the number of counting processes
+        chunks_per_process: the number of byte ranges a plain file is split into per process
+    Returns:
+        a Counter, in the order of the first occurrence of the tokens
+    """
+    tasks = [(data_path, start, end, sample_tokens) for data_path in data_files
+             for start, end in split_file(data_path, processes * chunks_per_process)]
+    counter = Counter()
+    if processes <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            counter.update(_count_task(task))
+        return counter
+    pool = multiprocessing.Pool(processes)
+    try:
+        # imap returns the ranges in file order, so the first occurrence order is kept
+        for range_counter in pool.imap(_count_task, tasks):
+            counter.update(range_counter)
+    finally:
+        pool.close()
+        pool.join()
+    return counter